@@ -7,81 +7,221 @@ import client   # Astrometry.net API
 import praw     # Reddit API
 import pyimgur  # Imgur API
 
-import math
+import heapq
 import time
 import io
+import base64
+import tempfile
 import sys
-import subprocess
+import socket
+import os
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import argparse
-import urlparse
 from string import Template
 from collections import deque
 import logging
 
 import urllib2
 import requests
-from lxml import etree
-from PIL import Image
-
-import ssl
-
+from PIL import Image, ImageFile, ImageDraw, ImageFont
 
 import credentials
+from poller import Poller
+from store import Store
+from workqueue import WorkQueue
+from keywords import KeywordMatcher, BLACKLIST, WHITELIST
+import transport
+import ratelimit
+import resolvers
+import fingerprint
+import geometry
+import starfield
+from metrics import Metrics
 
 
 NEW_POSTS = 100     # number of new posts to go through
+MAX_NEW_POSTS = 1000  # max number of new posts processed in one loop
+CURSOR_RESET = 3    # number of loops without new posts before the cursor is reset
 MAX_SKIPPED = 1000  # remember only last n skipped posts
 MAX_TAGS = 8        # when there's more than n tags, filter out the stars
+MAX_HISTORY = 1000  # number of own comments indexed on the first start
 REST_TIME = 180     # time to rest between each loop
+MIN_REST_TIME = 60  # time to rest when many posts arrive
+MAX_REST_TIME = 360 # time to rest when no posts arrive
 ERROR_TIME = 60     # time to rest on API error
-TTL = 10            # number of tries for every post
+SOLVE_TIME = 1800   # time limit for solving every post
+POLL_INTERVAL = 10  # time between the upload and the first poll
+MAX_POLL_INTERVAL = 300  # max time between two polls of a submission
+STATE_FILE = "astrobot.db"  # persistent state of the bot
+QUEUE_FILE = "queue.db"     # work queue of the worker processes
+QUEUE_CHECK_TIME = 10       # time between checks of the work queue
+ANNOTATE_ATTEMPTS = 3       # number of tries to annotate every solved post
+POLL_WORKERS = 16   # number of submissions polled at once
+POLL_TIMEOUT = 30   # time limit for a single poll request
+SOCKET_TIMEOUT = 60 # time limit for any blocking socket operation
+PROBE_SIZE = 256 * 1024  # max bytes read to find out the location is an image
+PROBE_CHUNK = 4096       # size of a single read while probing
+ANNOTATED_URL = "http://nova.astrometry.net/annotated_display/%s"
+IMGUR_UPLOAD_URL = "https://api.imgur.com/3/image"
+HTTP_POOL_SIZE = 16 # max connections kept alive to every host
+HTTP_RETRIES = 3    # number of retries of failed connections and server errors
+RESOLVED_TTL = 86400  # time to remember direct image urls
+FAILED_TTL = 21600    # time to remember urls which couldn't be resolved
+METRICS_FILE = "metrics.json"  # metrics dumped after every loop
+IMGUR_TOKEN_LIFETIME = 3600  # time the imgur access token is valid
+TOKEN_MARGIN = 300  # time before the expiration when the token is refreshed
+DOWNSAMPLE_SIZE = 0 # max dimension of uploaded images, 0 sends the original url
+HASH_DISTANCE = 6   # max number of different bits of hashes of duplicate images
+ASPECT_TOLERANCE = 0.01  # max relative difference of aspect ratios of duplicate images
+MIN_CONFIDENCE = 0    # images less likely to be star fields are not sent for solution, 0 sends all
+EDIT_DELAY = 4      # time between posting a comment and inserting its id
+CONSTELLATIONS_FILE = "constellations.dat"  # IAU constellation boundaries, optional
 
 reload(sys)
 sys.setdefaultencoding('utf8')
 
 
+class AstrometryClient(client.client.Client):
+    """
+    Astrometry client sending requests through the shared HTTP session.
+    File uploads are left to the original client.
+    """
+    def __init__(self, http, **kwargs):
+        client.client.Client.__init__(self, **kwargs)
+        self.http = http
+
+    def send_request(self, service, args={}, file_args=None):
+        if file_args is not None:
+            return client.client.Client.send_request(self, service, args, file_args)
+
+        args = dict(args)
+        if self.session is not None:
+            args["session"] = self.session
+
+        response = self.http.post(self.get_url(service), data={"request-json": json.dumps(args)})
+        response.raise_for_status()
+        result = response.json()
+        if result.get("status") == "error":
+            raise client.client.RequestError("server error message: " +
+                                             result.get("errormessage", "(none)"))
+        return result
+
+
 class AstroBot:
-    def __init__(self):
+    def __init__(self, queue=None, poll_workers=0, annotate_workers=0):
+        # timings and counters of the bot
+        self.metrics = Metrics()
+
+        # every process paces the APIs on its own, so their limits are
+        # split between the processes: the main one alone calls reddit,
+        # the annotate workers Imgur and all of them Astrometry
+        self.services = ratelimit.SERVICES
+        if queue is not None:
+            self.services = ratelimit.share(ratelimit.SERVICES, {
+                "imgur": annotate_workers,
+                "astrometry": 1 + poll_workers + annotate_workers})
+
+        # HTTP connections shared by all the APIs, paced by their rate limits
+        self.http = transport.Session(credentials.USER_AGENT, pool_size=HTTP_POOL_SIZE,
+                                      retries=HTTP_RETRIES, metrics=self.metrics,
+                                      limiter=ratelimit.RateLimiter(self.services))
+
+        # persistent state
+        self.store = Store(STATE_FILE)
+
         # Imgur API
         self.imgur = pyimgur.Imgur(credentials.IMGUR_CLIENT_ID, \
                                 client_secret=credentials.IMGUR_CLIENT_SECRET)
-        self.context = ssl._create_unverified_context()
-        authorized = False
-        # TODO: automatize this
-        while (not authorized):
-            sys.stdout.flush()
-            print "Get PIN on", credentials.IMGUR_AUTH_URL
-            pin = raw_input("Enter PIN: ")
-            try:
-                self.imgur.exchange_pin(pin)
-                authorized = True
-            except:
-                print "[ERROR]:", "Wrong PIN or other error. Authorize again."
+        self.imgur_expires = 0
 
         # Astrometry API
-        self.astrometry = client.client.Client()
-        self.astrometry.login(credentials.ASTROMETRY_ID)
+        self.astrometry = AstrometryClient(self.http)
+        self.poller = Poller(self.astrometry.send_request, POLL_WORKERS, POLL_TIMEOUT)
+
+        # calibration, annotated image and tags of a job are fetched at once
+        self.fetcher = ThreadPool(3)
 
         # Reddit API
         self.praw = praw.Reddit(user_agent=credentials.USER_AGENT)
-        self.praw.login(credentials.REDDIT_USER, credentials.REDDIT_PASSWORD)
+        self.http.share(self.praw.http)
+
+        # log in to all the APIs at once
+        tokens = dict((key, self.store.get("imgur_" + key))
+                      for key in ["refresh_token", "access_token", "expires"])
+        pool = ThreadPool(3)
+        logins = [pool.apply_async(self._login_imgur, (tokens,)),
+                  pool.apply_async(self.astrometry.login, (credentials.ASTROMETRY_ID,)),
+                  pool.apply_async(self.praw.login, (credentials.REDDIT_USER, credentials.REDDIT_PASSWORD))]
+        pool.close()
+        for login in logins:
+            login.get()
+        self._save_imgur_tokens()
+
+        # work queue shared with the worker processes,
+        # None if everything is done in this process
+        self.queue = queue
+        if self.queue is not None:
+            self.queue.release()
 
         # set of submissions currently being solved
-        # TODO: consider pickle
         self.solving = dict()
 
+        # heap of (next poll time, subid) of the submissions being solved
+        self.schedule = []
+
+        # hashes of the images being solved -> (aspect ratio, deadline),
+        # their duplicates wait for the solution instead of being uploaded
+        self.in_flight = dict()
+
+        # solved submissions waiting to be posted to reddit
+        self.solved = deque()
+
+        # heap of (due time, comment id, comment, text) of comment edits
+        self.edits = []
+
+        # time until which reddit refuses new comments
+        self.post_after = 0
+
+        # direct image urls of the links
+        self.resolver = resolvers.default_resolver(self.http, RESOLVED_TTL, FAILED_TTL)
+
+        # images downloaded in the current loop and not sent yet,
+        # url -> (data, resolution)
+        self.images = dict()
+
+        # time to rest after the current loop
+        self.rest_time = REST_TIME
+
+        # number of loops in a row without new posts
+        self.empty_loops = 0
+
         # queue of skipped reddit ids
-        self.skipped = deque(maxlen=MAX_SKIPPED)
+        self.skipped = deque(self.store.skipped(MAX_SKIPPED), maxlen=MAX_SKIPPED)
+
+        self._restore()
+        self._import_history()
+
+        # constellation of the solved images, if the boundaries are available
+        self.constellations = None
+        if os.path.exists(CONSTELLATIONS_FILE):
+            self.constellations = geometry.Constellations.load(CONSTELLATIONS_FILE)
 
-        # blacklist of words on /r/astrophotography+apod
-        self.blacklist = ["moon", "lunar", "sun", "solar", "eclipse",\
-            "mercury", "venus", "mars", "jupiter", "saturn", "uranus",\
-            "neptune", "trails", "panorama"]
+        # title classification by blacklisted and whitelisted words
+        self.keywords = KeywordMatcher(blacklist=BLACKLIST, whitelist=WHITELIST)
 
-        # whitelist of words on /r/astronomy+space+spaceporn
-        self.whitelist = ["galaxy", "ngc", "comet", "nebula", "constellation",\
-                "iss", "ison", "sky", "skies"]
+        # conditions on the posts, the cheapest first
+        self.filters = [("seen", self._filter_seen),
+                        ("title", self._filter_title),
+                        ("url", self._filter_url),
+                        ("solved", self._filter_solved),
+                        ("image", self._filter_image),
+                        ("comments", self._filter_comments)]
+
+        # number of rejected posts and time spent in every filter
+        self.filter_stats = dict((name, [0, 0.0]) for (name, _) in self.filters)
 
         # logging the solved posts
         self.logger = logging.getLogger("astrobot")
@@ -97,33 +237,71 @@ class AstroBot:
         """
         while True:
             try:
-                self.refresh()
+                start = time.time()
+
+                self._timed("refresh", self.refresh)
+
+                self._timed("read_inbox", self.read_inbox)
+
+                self._timed("process_new", self.process_new)
 
-                self.read_inbox()
+                self._timed("check_for_solved", self.check_for_solved)
 
-                self.process_new()
+                self._timed("post_solved", self.post_solved)
 
-                self.check_for_solved()
+                self._update_metrics(time.time() - start)
 
-                print "[INFO]:", "Sleeping for %d minute(s)." % (REST_TIME / 60)
-                time.sleep(REST_TIME)
+                print "[INFO]:", "Sleeping for %d minute(s)." % (self.rest_time / 60)
+                self.rest(self.rest_time)
             except (praw.errors.APIException, requests.exceptions.HTTPError, urllib2.HTTPError) as e:
+                self.metrics.inc("astrobot_errors_total", type=type(e).__name__)
                 print "[WARN]:", "API error. Sleeping for %d minute(s)." % (ERROR_TIME / 60)
                 print "[WARN]:", e
                 time.sleep(ERROR_TIME)
             except (KeyboardInterrupt, EOFError), e:
                 print "\n(quit)"
+                self.poller.close()
+                self.fetcher.close()
+                self.store.close()
+                if self.queue is not None:
+                    self.queue.close()
                 return -1
             except Exception as e:
+                self.metrics.inc("astrobot_errors_total", type=type(e).__name__)
                 print "[WARN]:", "Sleeping for %d minute(s)." % (ERROR_TIME / 60)
                 print "[WARN]:", e
                 time.sleep(ERROR_TIME)
 
+    def rest(self, seconds):
+        """
+        Sleep, but wake up to poll the submissions and edit the comments
+        which are due.
+        """
+        wake = time.time() + seconds
+        while time.time() < wake:
+            due = wake
+            if self.schedule:
+                due = min(due, self.schedule[0][0])
+            if self.edits:
+                due = min(due, self.edits[0][0])
+            if self.queue is not None:
+                due = min(due, time.time() + QUEUE_CHECK_TIME)
+            time.sleep(max(0, due - time.time()))
+
+            self._edit_comments()
+
+            self._timed("check_for_solved", self.check_for_solved)
+
+            self._timed("post_solved", self.post_solved)
+
     def refresh(self):
         """
-        Refresh the imgur access token.
+        Refresh the imgur access token if it's about to expire.
         """
-        self.imgur.refresh_access_token()
+        if time.time() > self.imgur_expires - TOKEN_MARGIN:
+            self.imgur.refresh_access_token()
+            self.imgur_expires = time.time() + IMGUR_TOKEN_LIFETIME
+            self._save_imgur_tokens()
 
     def process_new(self):
         """
@@ -131,46 +309,144 @@ class AstroBot:
         """
         subreddits = self.praw.get_subreddit("astrophotography+astronomy+space+spaceporn+apod")
 
-        # get last 100 posts
-        for post in subreddits.get_new(limit=NEW_POSTS):
+        # forget images loaded in the previous loop
+        self.images.clear()
+
+        # get posts submitted since the last loop
+        posts = self._new_posts(subreddits)
+        self._adapt_rest_time(len(posts))
+        for post in posts:
             if self._check_condition(post):
                 if not self._send_for_solution(post):
-                    self.skipped.append(post.id)
+                    self._skip(post.id)
             else:
-                self.skipped.append(post.id)
+                self._skip(post.id)
 
         # get hidden posts
         for post in self.praw.user.get_hidden():
             post.unhide()
             if self._check_condition(post, force=True):
-                if not self._send_for_solution(post):
-                    self.skipped.append(post.id)
+                if not self._send_for_solution(post, force=True):
+                    self._skip(post.id)
             else:
-                self.skipped.append(post.id)
+                self._skip(post.id)
+
+        for (name, _) in self.filters:
+            (rejected, elapsed) = self.filter_stats[name]
+            print "[INFO]:", "Filter %s rejected %d post(s) in %.2fs total." % (name, rejected, elapsed)
 
     def check_for_solved(self):
         """
-        Poll for the status of every solution
-        and process successful ones.
+        Poll for the status of solutions which are due
+        and queue successful ones for posting.
         """
-        for subid in list(self.solving):
+        now = time.time()
+        due = []
+        while self.schedule and self.schedule[0][0] <= now:
+            subid = heapq.heappop(self.schedule)[1]
+            if subid in self.solving:
+                due.append(subid)
+
+        results = self.poller.poll(due)
+        for subid in due:
             metadata = self.solving[subid]
-            result = self.astrometry.send_request("submissions/%d" % subid)
-            if len(result["job_calibrations"]) != 0:
-                metadata["job_id"] = result["job_calibrations"][0][0]
-                metadata["image_id"] = result["user_images"][0]
+            status = self._update_status(metadata, results.get(subid), now)
+            if status == "solved":
+                self.store.set_solved(subid, metadata["job_id"], metadata["image_id"])
+                self.solved.append(metadata)
+                del(self.solving[subid])
+            elif status == "failed":
+                self._unschedule(subid)
+            else:
+                self._schedule(metadata)
 
-                self._post_solved(metadata)
+    def post_solved(self):
+        """
+        Post the results of solved submissions to reddit. When reddit
+        limits the commenting, they wait and the rest of the loop goes on.
+        Submissions which fail are tried again after ERROR_TIME, up to
+        ANNOTATE_ATTEMPTS times, and don't hold up the others meanwhile.
+        """
+        if time.time() < self.post_after:
+            return
 
-                self.skipped.append(metadata["post"].id)
-                del(self.solving[subid])
-                continue
+        try:
+            if self.queue is not None:
+                self._post_queued()
 
-            metadata["TTL"] -= 1
-            if metadata["TTL"] < 1:
-                print "[WARN]:", "Failed to solve the post in time."
-                self.skipped.append(metadata["post"].id)
-                del(self.solving[subid])
+            for _ in range(len(self.solved)):
+                metadata = self.solved[0]
+                if metadata.get("retry_time", 0) > time.time():
+                    self.solved.rotate(-1)
+                    continue
+
+                try:
+                    self._post_solved(metadata)
+                except praw.errors.RateLimitExceeded:
+                    raise
+                except Exception as e:
+                    print "[WARN]:", "Posting of submission %d failed:" % metadata["id"], e
+                    metadata["attempts"] = metadata.get("attempts", 0) + 1
+                    if metadata["attempts"] < ANNOTATE_ATTEMPTS:
+                        metadata["retry_time"] = time.time() + ERROR_TIME
+                        self.solved.rotate(-1)
+                        continue
+                    self.in_flight.pop(metadata.get("hash"), None)
+
+                self._skip(metadata["post"].id)
+                self.store.remove_submission(metadata["id"])
+                self.solved.popleft()
+        except praw.errors.RateLimitExceeded as e:
+            print "[WARN]:", "Commenting is limited for %d second(s)." % e.sleep_time
+            self.post_after = time.time() + e.sleep_time
+
+    def start_workers(self, poll_workers, annotate_workers):
+        """
+        Start worker processes polling the submissions and annotating
+        solved images. This process keeps crawling reddit and posting
+        the comments, so it alone talks to reddit.
+        """
+        for stage in ["poll"] * poll_workers + ["annotate"] * annotate_workers:
+            worker = multiprocessing.Process(target=self.work, args=(stage,))
+            worker.daemon = True
+            worker.start()
+
+    def work(self, stage):
+        """
+        Work on one stage of the work queue. Run in worker process.
+        """
+        # connections can't be shared with the parent process,
+        # metrics of the workers are not exported
+        self.store = None
+        self.queue = self.queue.reopen()
+        self.metrics = Metrics()
+        self.http = transport.Session(credentials.USER_AGENT, pool_size=HTTP_POOL_SIZE,
+                                      retries=HTTP_RETRIES, metrics=self.metrics,
+                                      limiter=ratelimit.RateLimiter(self.services))
+        self.astrometry = AstrometryClient(self.http)
+        self.astrometry.login(credentials.ASTROMETRY_ID)
+        self.poller = Poller(self.astrometry.send_request, POLL_WORKERS, POLL_TIMEOUT)
+        self.fetcher = ThreadPool(3)
+
+        print "[INFO]:", "Worker %d started on stage %s." % (os.getpid(), stage)
+        while True:
+            try:
+                if stage == "poll":
+                    busy = self._work_poll()
+                else:
+                    busy = self._work_annotate()
+
+                if not busy:
+                    time.sleep(QUEUE_CHECK_TIME)
+            except (KeyboardInterrupt, EOFError), e:
+                self.poller.close()
+                self.fetcher.close()
+                self.queue.close()
+                return
+            except Exception as e:
+                print "[WARN]:", "Worker %d sleeping for %d minute(s)." % (os.getpid(), ERROR_TIME / 60)
+                print "[WARN]:", e
+                time.sleep(ERROR_TIME)
 
     def read_inbox(self):
         """
@@ -185,33 +461,368 @@ class AstroBot:
         message_not_ok = ("It seems you don't have right to remove the comment."
                           "If you believe you do, send me a PM!")
 
-        for msg in self.praw.get_inbox():
-            if "delete" in msg.subject and msg.new:
-                print "[INFO]:", "Deletion request was received."
-                remove_id = msg.body
-                deleted = False
-                me = self.praw.get_redditor(credentials.REDDIT_USER)
-                for c in me.get_comments(limit=None):
-                    if c.id == remove_id and msg.author == c.submission.author:
-                        c.delete()
-                        msg.mark_as_read()
-                        deleted = True
-                        break
-
-                if deleted:
-                    print "[INFO]:", "Deletion successful."
-                    self.praw.send_message(msg.author, 'Comment removed',
-                            message_ok.safe_substitute({"permalink": c.submission.permalink}))
-                else:
-                    self.praw.send_message(msg.author, 'Error while processing request',
-                            message_not_ok)
+        messages = [msg for msg in self.praw.get_inbox() if "delete" in msg.subject and msg.new]
+        if len(messages) == 0:
+            return
+        print "[INFO]:", "%d deletion request(s) were received." % len(messages)
+
+        # fetch all the requested comments at once
+        ids = set(msg.body.strip() for msg in messages if msg.body.strip().isalnum())
+        comments = self._get_comments(ids)
+
+        for msg in messages:
+            remove_id = msg.body.strip()
+            deleted = False
+            c = comments.get(remove_id)
+            if c is not None and msg.author:
+                (author, permalink) = self._comment_owner(c)
+                if author is not None and author.lower() == msg.author.name.lower():
+                    c.delete()
+                    self.store.remove_comment(c.id)
                     msg.mark_as_read()
+                    deleted = True
+
+            if deleted:
+                print "[INFO]:", "Deletion successful."
+                self.praw.send_message(msg.author, 'Comment removed',
+                        message_ok.safe_substitute({"permalink": permalink}))
+            else:
+                self.praw.send_message(msg.author, 'Error while processing request',
+                        message_not_ok)
+                msg.mark_as_read()
 
     # --- helper methods
+    def _login_imgur(self, tokens):
+        """
+        Authorize to Imgur with the stored tokens, or ask for PIN
+        if there are none or they're not valid anymore.
+        """
+        if tokens["refresh_token"] is not None:
+            self.imgur.refresh_token = tokens["refresh_token"]
+
+            # access token still valid, no need to ask for a new one
+            if tokens["access_token"] is not None and \
+                    float(tokens["expires"]) > time.time() + TOKEN_MARGIN:
+                self.imgur.access_token = tokens["access_token"]
+                self.imgur_expires = float(tokens["expires"])
+                return
+
+            try:
+                self.imgur.refresh_access_token()
+                self.imgur_expires = time.time() + IMGUR_TOKEN_LIFETIME
+                return
+            except Exception as e:
+                print "[WARN]:", "Stored Imgur token was refused:", e
+
+        authorized = False
+        while (not authorized):
+            sys.stdout.flush()
+            print "Get PIN on", credentials.IMGUR_AUTH_URL
+            pin = raw_input("Enter PIN: ")
+            try:
+                self.imgur.exchange_pin(pin)
+                self.imgur_expires = time.time() + IMGUR_TOKEN_LIFETIME
+                authorized = True
+            except:
+                print "[ERROR]:", "Wrong PIN or other error. Authorize again."
+
+    def _save_imgur_tokens(self):
+        """
+        Store Imgur tokens so that the next start doesn't need PIN.
+        Worker processes don't have the store.
+        """
+        if self.store is None:
+            return
+        self.store.set("imgur_refresh_token", self.imgur.refresh_token)
+        self.store.set("imgur_access_token", self.imgur.access_token)
+        self.store.set("imgur_expires", self.imgur_expires)
+
+    def _timed(self, stage, function):
+        """
+        Run stage of the main loop and measure it.
+        """
+        with self.metrics.timed("astrobot_stage", stage=stage):
+            function()
+
+    def _update_metrics(self, cycle_time):
+        """
+        Record the state after the loop and dump the metrics.
+        """
+        self.metrics.observe("astrobot_cycle_seconds", cycle_time)
+        self.metrics.set("astrobot_last_cycle_seconds", cycle_time)
+        self.metrics.set("astrobot_rest_time_seconds", self.rest_time)
+
+        self.metrics.set("astrobot_queue_size", len(self.solving), queue="solving")
+        self.metrics.set("astrobot_queue_size", len(self.solved), queue="solved")
+        self.metrics.set("astrobot_queue_size", len(self.skipped), queue="skipped")
+        if self.queue is not None:
+            for stage in ["poll", "annotate", "post"]:
+                self.metrics.set("astrobot_queue_size", self.queue.pending(stage), queue=stage)
+
+        for (name, (rejected, elapsed)) in self.filter_stats.items():
+            self.metrics.set("astrobot_filter_rejected", rejected, filter=name)
+            self.metrics.set("astrobot_filter_seconds", elapsed, filter=name)
+
+        if METRICS_FILE:
+            self.metrics.dump(METRICS_FILE)
+
+    def _get_comments(self, ids):
+        """
+        Fetch the bot's comments by their ids, return dict id -> comment.
+        """
+        fullnames = ["t1_" + comment_id for comment_id in ids]
+        comments = dict()
+        for i in range(0, len(fullnames), 100):
+            for c in self.praw.get_info(thing_id=fullnames[i:i + 100]):
+                if c.author and c.author.name.lower() == credentials.REDDIT_USER.lower():
+                    comments[c.id] = c
+        return comments
+
+    def _comment_owner(self, c):
+        """
+        Return name of the author of the post the comment belongs to and
+        permalink of the post. Comments posted before the index existed
+        need to fetch their post.
+        """
+        indexed = self.store.comment(c.id)
+        if indexed is not None:
+            return (indexed["author"], indexed["permalink"])
+
+        if c.submission.author is None:
+            return (None, c.submission.permalink)
+        return (c.submission.author.name, c.submission.permalink)
+
+    def _get_posts(self, ids):
+        """
+        Fetch reddit posts by their ids, return dict id -> post.
+        """
+        fullnames = ["t3_" + post_id for post_id in ids]
+        posts = dict()
+        for i in range(0, len(fullnames), 100):
+            for post in self.praw.get_info(thing_id=fullnames[i:i + 100]):
+                posts[post.id] = post
+        return posts
+
+    def _restore(self):
+        """
+        Resume the submissions stored by the previous run.
+        """
+        stored = self.store.submissions()
+        if not stored:
+            return
+
+        posts = self._get_posts(metadata["post_id"] for metadata in stored)
+
+        for metadata in stored:
+            post = posts.get(metadata.pop("post_id"))
+            if post is None:
+                self.store.remove_submission(metadata["id"])
+                continue
+
+            metadata["post"] = post
+            if "job_id" in metadata:
+                self.solved.append(metadata)
+            else:
+                self.solving[metadata["id"]] = metadata
+                heapq.heappush(self.schedule, (metadata["next_poll"], metadata["id"]))
+
+        print "[INFO]:", "Resumed %d submission(s)." % (len(self.solving) + len(self.solved))
+
+    def _import_history(self):
+        """
+        Index the bot's comments posted before the index existed, once,
+        so that already solved posts are recognized without asking reddit.
+        """
+        if self.store.get("history_imported") is not None:
+            return
+
+        me = self.praw.get_redditor(credentials.REDDIT_USER)
+        self.store.add_history([(c.id, c.link_id[3:]) for c in me.get_comments(limit=MAX_HISTORY)])
+        self.store.set("history_imported", "1")
+
+    def _new_posts(self, subreddits):
+        """
+        Get posts newer than the last seen one, oldest first.
+        If there is no cursor yet or it seems to be stale (e.g. the post
+        was removed), fall back to the last NEW_POSTS posts.
+        """
+        cursor = self.store.get("last_seen")
+        if cursor is None or self.empty_loops >= CURSOR_RESET:
+            posts = list(subreddits.get_new(limit=NEW_POSTS))
+            posts.reverse()
+            self.empty_loops = 0
+        else:
+            posts = []
+            while len(posts) < MAX_NEW_POSTS:
+                page = list(subreddits.get_new(limit=NEW_POSTS, params={"before": cursor}))
+                posts.extend(reversed(page))
+                if len(page) > 0:
+                    cursor = page[0].fullname
+                if len(page) < NEW_POSTS:
+                    break
+
+            if len(posts) == 0:
+                self.empty_loops += 1
+            else:
+                self.empty_loops = 0
+
+        if len(posts) > 0:
+            self.store.set("last_seen", posts[-1].fullname)
+
+        return posts
+
+    def _adapt_rest_time(self, new_posts):
+        """
+        Rest longer when nothing happens and shorter when posts keep coming.
+        """
+        if new_posts == 0:
+            self.rest_time = min(self.rest_time * 2, MAX_REST_TIME)
+        elif new_posts >= NEW_POSTS / 4:
+            self.rest_time = max(self.rest_time / 2, MIN_REST_TIME)
+        else:
+            self.rest_time = REST_TIME
+
+    def _update_status(self, metadata, result, now):
+        """
+        Update the submission by its polled status (None if the poll
+        failed) and return "solved", "failed" or "pending".
+        """
+        if result is not None and len(result["job_calibrations"]) != 0:
+            metadata["job_id"] = result["job_calibrations"][0][0]
+            metadata["image_id"] = result["user_images"][0]
+            return "solved"
+
+        if result is not None and result.get("job_status") == "failure":
+            print "[INFO]:", "Astrometry failed to solve the post."
+            return "failed"
+
+        if now > metadata["deadline"]:
+            print "[WARN]:", "Failed to solve the post in time."
+            return "failed"
+
+        # poll often right after the upload, less and less later
+        metadata["interval"] = min(metadata["interval"] * 2, MAX_POLL_INTERVAL)
+        metadata["next_poll"] = now + metadata["interval"]
+        return "pending"
+
+    def _serialize(self, metadata):
+        """
+        Return metadata without the reddit post, to be passed to worker processes.
+        """
+        post = metadata["post"]
+        data = dict((key, value) for (key, value) in metadata.items() if key != "post")
+        data["post_id"] = post.id
+        data["author"] = self._label_author(post)
+        return data
+
+    def _work_poll(self):
+        """
+        Poll the submissions which are due and pass the solved ones
+        to annotation. Return False if there was nothing to do.
+        """
+        tasks = self.queue.claim("poll", POLL_WORKERS)
+        results = self.poller.poll([metadata["id"] for (_, metadata) in tasks])
+
+        now = time.time()
+        for (task_id, metadata) in tasks:
+            status = self._update_status(metadata, results.get(metadata["id"]), now)
+            if status == "solved":
+                self.queue.move(task_id, "annotate", metadata)
+            elif status == "failed":
+                self.queue.done(task_id)
+            else:
+                self.queue.move(task_id, "poll", metadata, metadata["next_poll"])
+
+        return len(tasks) > 0
+
+    def _work_annotate(self):
+        """
+        Annotate one solved submission and pass it to posting.
+        Return False if there was nothing to do.
+        """
+        tasks = self.queue.claim("annotate")
+        for (task_id, metadata) in tasks:
+            try:
+                self._annotate(metadata)
+            except Exception as e:
+                print "[WARN]:", "Annotation of submission %d failed:" % metadata["id"], e
+                metadata["attempts"] = metadata.get("attempts", 0) + 1
+                if metadata["attempts"] < ANNOTATE_ATTEMPTS:
+                    self.queue.move(task_id, "annotate", metadata, time.time() + ERROR_TIME)
+                else:
+                    self.queue.done(task_id)
+                continue
+
+            self.queue.move(task_id, "post", metadata)
+
+        return len(tasks) > 0
+
+    def _post_queued(self):
+        """
+        Post the submissions annotated by the worker processes.
+        """
+        tasks = self.queue.claim("post", 100)
+        if len(tasks) == 0:
+            return
+
+        try:
+            posts = self._get_posts(metadata["post_id"] for (_, metadata) in tasks)
+            while tasks:
+                (task_id, metadata) = tasks[0]
+                post = posts.get(metadata["post_id"])
+                if post is not None:
+                    metadata["post"] = post
+                    self._publish(metadata)
+                self.queue.done(task_id)
+                tasks.pop(0)
+        finally:
+            # give back what wasn't posted because of an error
+            for (task_id, metadata) in tasks:
+                metadata.pop("post", None)
+                self.queue.move(task_id, "post", metadata)
+
+    def _schedule(self, metadata):
+        """
+        Plan the next poll of the submission.
+        """
+        heapq.heappush(self.schedule, (metadata["next_poll"], metadata["id"]))
+        self.store.update_schedule(metadata["id"], metadata["next_poll"], metadata["interval"])
+
+    def _unschedule(self, subid):
+        """
+        Give up the submission.
+        """
+        self._skip(self.solving[subid]["post"].id)
+        self.in_flight.pop(self.solving[subid].get("hash"), None)
+        self.store.remove_submission(subid)
+        del(self.solving[subid])
+
+    def _skip(self, post_id):
+        """
+        Remember the post so it's not processed again.
+        """
+        self.skipped.append(post_id)
+        self.store.skip(post_id, MAX_SKIPPED)
+
     def _check_condition(self, post, force=False):
         """
         Decide whether to process the reddit post.
         """
+        for (name, condition) in self.filters:
+            start = time.time()
+            passed = condition(post, force)
+            stats = self.filter_stats[name]
+            stats[1] += time.time() - start
+            if not passed:
+                stats[0] += 1
+                return False
+
+        return True
+
+    def _filter_seen(self, post, force):
+        """
+        Skip posts already processed, saved (solved) or posted by blacklisted authors.
+        """
         if not force and post.id in self.skipped:
             return False
 
@@ -221,174 +832,359 @@ class AstroBot:
         if post.author and post.author.name.lower() == "eorequis":
             return False
 
-        blacklist_matches = sum(word in post.title.lower() for word in self.blacklist)
-        whitelist_matches = sum(word in post.title.lower() for word in self.whitelist)
+        return True
+
+    def _filter_title(self, post, force):
+        """
+        Skip posts whose title suggests there are no stars to solve.
+        """
+        if force:
+            return True
+
+        matches = self.keywords.count(post.title)
         if post.subreddit.display_name.lower() in ["astrophotography", "apod"]:
-            if not force and blacklist_matches == 1 and whitelist_matches == 0:
+            if matches["blacklist"] == 1 and matches["whitelist"] == 0:
                 return False
         else:
-            if not force and whitelist_matches == 0:
+            if matches["whitelist"] == 0:
                 return False
 
-        # TODO: fix 'load more comments'
-        post.replace_more_comments(limit=16, threshold=1)
-        for comment in praw.helpers.flatten_tree(post.comments):
-            if isinstance(comment, praw.objects.Comment) and \
-                    "astrometry.net" in comment.body.lower():
-                return False
+        return True
 
+    def _filter_url(self, post, force):
+        """
+        Skip posts linking to locations which can't be resolved,
+        without accessing the network.
+        """
+        return self.resolver.supports(post.url)
+
+    def _filter_image(self, post, force):
+        """
+        Skip posts whose image can't be resolved or opened.
+        """
         try:
-            if (self._parse_url(post.url) is None):
+            image_url = self._resolve_url(post.url)
+            if image_url is None or self._image(image_url)[1] is None:
                 return False
-        except urllib2.HTTPError as e:
+        except requests.exceptions.RequestException as e:
             print "[INFO]:", "Location can't be opened."
             return False
 
         return True
 
-    def _send_for_solution(self, post):
+    def _filter_solved(self, post, force):
+        """
+        Skip posts which were already solved by the bot, by its index of comments.
+        """
+        return not self.store.has_comment_on(post.id)
+
+    def _filter_comments(self, post, force):
+        """
+        Skip posts which were already solved by somebody else. Only the
+        comments loaded with the post are checked, the tree is not expanded.
+        """
+        for comment in praw.helpers.flatten_tree(post.comments):
+            if isinstance(comment, praw.objects.Comment) and \
+                    "astrometry.net" in comment.body.lower():
+                # the image downloaded by the previous filter won't be sent
+                self.images.pop(self._resolve_url(post.url), None)
+                return False
+
+        return True
+
+    def _send_for_solution(self, post, force=False):
         """
         Process the reddit post and send
         to nova.Astrometry.net.
         """
-        image_url = self._parse_url(post.url)
+        image_url = self._resolve_url(post.url)
+        if image_url is None:
+            return False
 
-        # get resolution of photo (used for computing range)
-        fd = urllib2.urlopen(image_url, context=self.context)
+        # the whole image, downloaded once for all the steps below,
+        # and its resolution (used for computing range)
         try:
-            image_file = io.BytesIO(fd.read())
-            im = Image.open(image_file)
-        except IOError:
+            (data, image_size) = self._image(image_url)
+            self.images.pop(image_url, None)
+            if image_size is None:
+                return False
+            image_hash = fingerprint.dhash(data)
+            (score, stats) = starfield.confidence(data)
+        except (IOError, requests.exceptions.RequestException) as e:
+            print "[INFO]:", "Image can't be downloaded or decoded:", e
             return False
 
+        # the same image was already solved, e.g. it's a cross-post
+        aspect = float(image_size[0]) / image_size[1]
+        if fingerprint.informative(image_hash):
+            known = self.store.find_solution(image_hash, aspect, HASH_DISTANCE, ASPECT_TOLERANCE)
+            if known is not None:
+                self._reuse_solution(post, known, image_size)
+                return False
+            if self._in_flight(image_hash, aspect):
+                # hidden posts are checked again in the next loop
+                print "[INFO]:", "Post", post.permalink, "waits for its duplicate to be solved."
+                post.hide()
+                return False
+
+        # don't spend the solving on images which don't look like star fields
+        if score < MIN_CONFIDENCE and not force:
+            print "[INFO]:", "Image doesn't look like a star field " \
+                             "(confidence %.2f, %d star(s), background %d)." % \
+                             (score, stats["stars"], stats["background"])
+            self.metrics.inc("astrobot_rejected_images_total")
+            return False
+
+        # shrink big images, so they're solved faster
+        image = None
+        scale = 1.0
+        if DOWNSAMPLE_SIZE and max(image_size) > DOWNSAMPLE_SIZE:
+            try:
+                (image, scale) = self._downsample(data, image_size)
+            except IOError:
+                return False
 
         # upload
         print "[INFO]:", "Sending post", post.permalink, "to nova.Astrometry.net"
-        subid = self._upload(image_url)
+        subid = self._upload(image_url, image)
+        if subid is None:
+            return False
 
         metadata = dict()
         metadata["id"] = subid
         metadata["post"] = post
-        metadata["image_size"] = im.size
-
-        metadata["TTL"] = TTL
+        metadata["image_size"] = image_size
+        metadata["scale"] = scale
+        if fingerprint.informative(image_hash):
+            metadata["hash"] = image_hash
+            metadata["aspect"] = aspect
+
+        metadata["interval"] = POLL_INTERVAL
+        metadata["next_poll"] = time.time() + POLL_INTERVAL
+        metadata["deadline"] = time.time() + SOLVE_TIME
+        if "hash" in metadata:
+            self.in_flight[image_hash] = (aspect, metadata["deadline"])
+
+        if self.queue is not None:
+            self.queue.put("poll", self._serialize(metadata), metadata["next_poll"])
+            return False
 
         if subid not in self.solving:
             self.solving[subid] = metadata
+            self.store.add_submission(metadata)
+            heapq.heappush(self.schedule, (metadata["next_poll"], subid))
             return False
         return True
 
+    def _in_flight(self, image_hash, aspect):
+        """
+        Decide whether a duplicate of the image is being solved.
+        """
+        now = time.time()
+        for (other, (other_aspect, deadline)) in self.in_flight.items():
+            if deadline < now:
+                del(self.in_flight[other])
+            elif abs(other_aspect - aspect) <= aspect * ASPECT_TOLERANCE and \
+                    fingerprint.distance(image_hash, other) <= HASH_DISTANCE:
+                return True
+        return False
+
+    def _reuse_solution(self, post, known, image_size):
+        """
+        Queue the post for commenting with the solution of its duplicate,
+        without uploading it to Astrometry. The annotated image is reused
+        only if it's labelled with the same author.
+        """
+        print "[INFO]:", "Post", post.permalink, "is a duplicate of submission", known["id"]
+        self.metrics.inc("astrobot_duplicates_total")
+
+        metadata = known
+        metadata["post"] = post
+        metadata["image_size"] = image_size
+        metadata["scale"] = 1.0
+        if metadata.pop("author") != self._label_author(post):
+            del(metadata["annotated_image"])
+
+        if self.queue is not None:
+            self.queue.put("annotate", self._serialize(metadata))
+        else:
+            self.solved.append(metadata)
+
     def _post_solved(self, metadata):
         """
         Post results of solved submission to the
         comment section of the reddit post.
         """
-        post = metadata["post"]
+        metadata["author"] = self._label_author(metadata["post"])
+        self._annotate(metadata)
+        self._publish(metadata)
+
+    def _label_author(self, post):
+        """
+        Name shown on the annotated image, only for /r/astrophotography.
+        """
+        if ("astrophotography" in post.subreddit.display_name.lower() and post.author):
+            return post.author.name
+        return ""
+
+    def _annotate(self, metadata):
+        """
+        Get calibration, annotated image and tags of solved submission,
+        unless they're known from its duplicate. They're fetched at once.
+        """
+        # done here, the store can't be used from the fetching threads
+        self.refresh()
 
         # calibration
-        (ra, de, radius, rg) = self._get_calibration(metadata["job_id"], metadata["image_size"])
-        metadata["rectascension"] = ra
-        metadata["declination"] = de
-        metadata["range"] = rg
-        metadata["radius"] = radius
+        calibration = None
+        if "range" not in metadata:
+            calibration = self.fetcher.apply_async(self._get_calibration,
+                    (metadata["job_id"], metadata["image_size"], metadata["scale"]))
 
         # annotated image
-        metadata["author"] = ""
-        if ("astrophotography" in post.subreddit.display_name.lower() and post.author):
-            metadata["author"] = post.author.name
-        metadata["annotated_image"] = self._upload_annotated(metadata["job_id"], metadata["author"])
+        annotated_image = None
+        if metadata.get("annotated_image") is None:
+            annotated_image = self.fetcher.apply_async(self._upload_annotated,
+                    (metadata["job_id"], metadata["author"]))
 
         # tags
-        metadata["tags"] = self._get_tags(metadata["job_id"])
+        tags = None
+        if "tags" not in metadata:
+            tags = self.fetcher.apply_async(self._get_tags, (metadata["job_id"],))
+
+        if calibration is not None:
+            (ra, de, radius, rg) = calibration.get()
+            metadata["rectascension"] = ra
+            metadata["declination"] = de
+            metadata["range"] = rg
+            metadata["radius"] = radius
+        if annotated_image is not None:
+            metadata["annotated_image"] = annotated_image.get()
+        if tags is not None:
+            metadata["tags"] = tags.get()
+
+    def _publish(self, metadata):
+        """
+        Comment the annotated submission on reddit.
+        """
+        post = metadata["post"]
         if (metadata["annotated_image"] is not None):
             comment = self._generate_comment(metadata)
             c = post.add_comment(comment)
 
-            time.sleep(4)
-            c.edit(comment.replace('____id____', str(c.id)))
+            author = post.author.name if post.author else None
+            self.store.add_comment(c.id, post.id, author, post.permalink)
+
+            # the id is inserted later, without holding up the loop
+            heapq.heappush(self.edits, (time.time() + EDIT_DELAY, c.id, c,
+                                        comment.replace('____id____', str(c.id))))
             post.upvote()  # can I do that?
             post.save()
+            self.store.add_tags(post.id, post.subreddit.display_name, metadata["tags"], time.time())
+            if "hash" in metadata:
+                self.store.add_solution(metadata["hash"], metadata["aspect"], metadata)
+                self.in_flight.pop(metadata["hash"], None)
 
             self.logger.info("%s:%s" % (str(metadata["id"]), post.id))
             print "[INFO]:", "Post", post.permalink, "successfully solved."
 
-    def _parse_url(self, rawUrl):
+    def _edit_comments(self):
         """
-        Get direct image URL for web pages.
+        Make the comment edits which are due.
         """
-        url = urlparse.urlparse(rawUrl)
+        now = time.time()
+        while self.edits and self.edits[0][0] <= now:
+            (_, _, c, text) = heapq.heappop(self.edits)
+            c.edit(text)
 
-        # check whether the url is accessible
-        req = urllib2.Request(rawUrl, headers={'User-Agent' : credentials.USER_AGENT})
-        fd = urllib2.urlopen(req, context=self.context)
-
-        p = url.path.lower()
-        if p.endswith(".jpg") or p.endswith(".jpeg") or p.endswith(".png") or p.endswith(".gif"):
-            return rawUrl
+    def _get(self, url):
+        """
+        Download the location, raise HTTPError on failure.
+        """
+        response = self.http.download(url)
+        response.raise_for_status()
+        return response
 
-        # get direct url from imgur (skip sets and albums)
-        if "imgur.com" in url.netloc and "a/" not in url.path and ("," not in url.path) and ("gifv" not in url.path):
-            newloc = "i." + url.netloc
-            newpath = url.path
-            if newpath.endswith("/new"):
-                newpath.replace("/new", "")
-            newpath += ".jpg"
-            newpath = newpath.replace("gallery/", "")
-            newUrl = urlparse.ParseResult(url.scheme, newloc, newpath,
-                        url.params, url.query, url.fragment)
+    def _resolve_url(self, rawUrl):
+        """
+        Get direct image URL, None if it can't be resolved.
+        """
+        return self.resolver.resolve(rawUrl)
 
-            return newUrl.geturl()
+    def _image(self, image_url):
+        """
+        Download the image and get its resolution, with a single request.
+        The resolution is found at the beginning of the file, the download
+        is stopped there if the location is not an image.
+        Returns (data, resolution), both None if it's not an image.
+        """
+        if image_url in self.images:
+            return self.images[image_url]
 
-        # get direct url from flickr
-        if "flickr.com" in url.netloc:
-            path = filter(lambda x: x != '', url.path.split('/'))
-            if path[0] == 'photos' and len(path) >= 3:
-                newpath = '/photos/%s/%s/sizes/l' % (path[1], path[2])
-                newUrl = urlparse.ParseResult(url.scheme, url.netloc, newpath,
-                        url.params, url.query, url.fragment)
+        response = self.http.download(image_url, stream=True)
+        response.raise_for_status()
 
+        size = None
+        chunks = []
+        parser = ImageFile.Parser()
+        try:
+            read = 0
+            for chunk in response.iter_content(PROBE_CHUNK):
+                chunks.append(chunk)
+                if size is not None:
+                    continue
+                read += len(chunk)
                 try:
-                    file = urllib2.urlopen(newUrl.geturl(), context=self.context)
-                    tree = etree.HTML(file.read())
-                    staticUrl = tree.xpath('//div[@id="allsizes-photo"]/img/@src')
-                    if len(staticUrl):
-                        return staticUrl[0]
-                except:
-                    pass
-
-        if "apod.nasa.gov" in url.netloc:
-            try:
-                file = urllib2.urlopen(url.geturl(), context=self.context)
-                tree = etree.HTML(file.read())
-                directUrl = tree.xpath('//img/@src')
-                if len(directUrl):
-                    return "http://apod.nasa.gov/apod/" + directUrl[0]
-            except:
-                pass
+                    parser.feed(chunk)
+                except IOError:
+                    # not an image, network errors are not caught here
+                    break
+                if parser.image is not None:
+                    size = parser.image.size
+                elif read >= PROBE_SIZE:
+                    break
+        finally:
+            response.close()
+
+        image = (b"".join(chunks), size) if size is not None else (None, None)
+        self.images[image_url] = image
+        return image
+
+    def _downsample(self, data, image_size):
+        """
+        Shrink the image data to DOWNSAMPLE_SIZE.
+        Return JPEG data and the ratio of new and original size.
+        """
+        image = Image.open(io.BytesIO(data))
 
-        if "wikipedia.org" in url.netloc and "File:" in url.path:
-            try:
-                file = urllib2.urlopen(url.geturl(), context=self.context)
-                tree = etree.HTML(file.read())
-                directUrl = tree.xpath('//div[@class="fullMedia"]/a/@href')[0]
-                if len(directUrl):
-                    return "http:" + directUrl
-            except:
-                pass
+        # let JPEG decoder do most of the work
+        ratio = float(DOWNSAMPLE_SIZE) / max(image_size)
+        image.draft("RGB", (int(image_size[0] * ratio), int(image_size[1] * ratio)))
+        image = image.convert("RGB")
+        image.thumbnail((DOWNSAMPLE_SIZE, DOWNSAMPLE_SIZE), Image.ANTIALIAS)
 
-        return None
+        data = io.BytesIO()
+        image.save(data, "JPEG", quality=95)
+        return (data.getvalue(), float(image.size[0]) / image_size[0])
 
-    def _upload(self, image_url):
+    def _upload(self, image_url, image=None):
         """
         Upload the image to Astrometry and return submission id.
+        If image data are given, they are uploaded instead of the url.
         """
         kwargs = dict(
                 allow_commercial_use="n",
                 allow_modifications="n",
                 publicly_visible="y")
-                #TODO: downsample if image too big...
 
-        result = self.astrometry.url_upload(image_url, **kwargs)
+        if image is None:
+            result = self.astrometry.url_upload(image_url, **kwargs)
+        else:
+            # the client uploads only files
+            with tempfile.NamedTemporaryFile(suffix=".jpg") as fd:
+                fd.write(image)
+                fd.flush()
+                result = self.astrometry.upload(fd.name, **kwargs)
 
         stat = result['status']
         if stat != 'success':
@@ -397,23 +1193,54 @@ class AstroBot:
 
         return result['subid']
 
-    # TODO: rewrite to pure python solution
     def _upload_annotated(self, job_id, author):
         """
         Get annotated image from astrometry, put label on it and upload to Imgur.
         """
+        image = Image.open(io.BytesIO(self._get(ANNOTATED_URL % job_id).content))
+        if author:
+            image = self._label(image, "image: %s@reddit" % author)
 
-        subprocess.check_call(["./annotate.sh", str(job_id), author])
+        data = io.BytesIO()
+        image.save(data, "PNG")
 
-        self.imgur.refresh_access_token()
         try:
-            uploaded_image = self.imgur.upload_image(path=str(job_id) + ".png",\
-                                album=credentials.ALBUM_ID)
+            uploaded_image = self._imgur_upload(data.getvalue(), album=credentials.ALBUM_ID)
             return uploaded_image.link
         except:
             print "[WARN]:", "Imgur error. Image not uploaded."
             return None
 
+    def _label(self, image, text):
+        """
+        Put white text on translucent black box to the bottom right corner.
+        """
+        PADDING = 4
+
+        image = image.convert("RGBA")
+        font = ImageFont.load_default()
+        (text_width, text_height) = font.getsize(text)
+        (width, height) = image.size
+
+        overlay = Image.new("RGBA", image.size, (0, 0, 0, 0))
+        draw = ImageDraw.Draw(overlay)
+        left = width - text_width - 2 * PADDING
+        top = height - text_height - 2 * PADDING
+        draw.rectangle((left, top, width, height), fill=(0, 0, 0, 160))
+        draw.text((left + PADDING, top + PADDING), text, font=font, fill=(255, 255, 255, 255))
+
+        return Image.alpha_composite(image, overlay)
+
+    def _imgur_upload(self, data, album=None):
+        """
+        Upload image from memory, pyimgur can upload only files or urls.
+        """
+        payload = {'album_id': album, 'image': base64.b64encode(data)}
+        response = self.http.post(IMGUR_UPLOAD_URL, data=payload,
+                                  headers={'Authorization': 'Bearer ' + self.imgur.access_token})
+        response.raise_for_status()
+        return pyimgur.Image(response.json()['data'], self.imgur)
+
     def _get_tags(self, job_id):
         """
         Get the resolved objects.
@@ -425,55 +1252,29 @@ class AstroBot:
 
         return tags
 
-    def _get_calibration(self, job_id, image_size):
+    def _get_calibration(self, job_id, image_size, scale=1.0):
         """
         Get calibration of solved job and parse it to
         r. ascension, declination, radius and range.
+        Scale is the ratio of the uploaded and original image size.
         """
         calibration = self.astrometry.send_request('jobs/%s/calibration' % str(job_id))
         ra = calibration['ra']
         de = calibration['dec']
         radius = calibration['radius']
 
-        max_span = max(image_size)
-        angular_scale = calibration['pixscale'] * max_span / 3600.0
-
-        TINY_FLOAT_VALUE = 1.0e-8
-        RADIUS_EARTH = 6378135.0        # in meters
-        VIEWABLE_ANGULAR_SCALE = 50.0   # in degrees
-
-        alpha = 0.5 * VIEWABLE_ANGULAR_SCALE * (math.pi / 180.0)
-        beta = 0.5 * angular_scale * (math.pi / 180.0)
-        if (beta > alpha):
-            beta = alpha
-        rg = RADIUS_EARTH * (1.0 - (math.sin(alpha - beta) /\
-                                   (math.sin(alpha) + TINY_FLOAT_VALUE)))
+        field = geometry.field_of_view(calibration['pixscale'] * scale, *image_size)
+        rg = geometry.view_range(field)
 
         return (float(ra), float(de), float(radius), float(rg))
 
-    def _hours_to_real(self, hours, minutes, seconds):
-        return hours + minutes / 60.0 + seconds / 3600.0
-
-    def _real_to_hours(self, real):
-        hours = int(real)
-        n = real - hours
-        if (n < 0):
-            n = -n
-
-        minutes = int(math.floor(n * 60))
-        n = n - minutes / 60.0
-        seconds = n * 3600
-
-        return (hours, minutes, seconds)
-
     def _wikisky_link(self, metadata):
         link = "http://server4.wikisky.org/v2"
 
         link += "?ra=" + str(metadata["rectascension"] / 15.0)
         link += "&de=" + str(metadata["declination"])
 
-        zoom = 18 - round(math.log(metadata["range"] / 90.0) / math.log(2))
-        link += "&zoom=" + str(int(zoom))
+        link += "&zoom=" + str(int(geometry.wikisky_zoom(metadata["range"])))
 
         link += "&show_grid=1&show_constellation_lines=1"
         link += "&show_constellation_boundaries=1&show_const_names=1"
@@ -487,8 +1288,7 @@ class AstroBot:
         link += "#longitude=" + str(metadata["rectascension"] - 180)
         link += "&latitude=" + str(metadata["declination"])
 
-        zoom = 20 - round(math.log(metadata["range"] / 90.0) / math.log(2))
-        link += "&zoom=" + str(int(zoom))
+        link += "&zoom=" + str(int(geometry.googlesky_zoom(metadata["range"])))
 
         return link
 
@@ -499,6 +1299,7 @@ class AstroBot:
         comment = ("*This is an automatically generated comment.*\n\n"
                    "---\n\n"
                    "$coordinates"
+                   "$constellation"
                    "$radius"
                    "$image"
                    "$tags"
@@ -523,8 +1324,16 @@ class AstroBot:
             model["advertise"] = "*If this is your photo, consider x-posting to /r/astrophotography!*\n\n"
 
         model["coordinates"] = "> Coordinates: "
-        model["coordinates"] += "%d^h %d^m %.2f^s , " % self._real_to_hours(metadata["rectascension"] / 15.0)
-        model["coordinates"] += "%d° %d' %.2f\"\n\n" % self._real_to_hours(metadata["declination"])
+        (_, hours, minutes, seconds) = geometry.sexagesimal(metadata["rectascension"] / 15.0, wrap=24)
+        model["coordinates"] += "%d^h %d^m %.2f^s , " % (hours, minutes, seconds)
+        (sign, degrees, minutes, seconds) = geometry.sexagesimal(metadata["declination"])
+        model["coordinates"] += "%s%d° %d' %.2f\"\n\n" % ("-" if sign < 0 else "", degrees, minutes, seconds)
+
+        model["constellation"] = ""
+        if self.constellations is not None:
+            abbreviation = str(self.constellations.find(metadata["rectascension"], metadata["declination"]))
+            if abbreviation:
+                model["constellation"] = "> Constellation: %s\n\n" % geometry.NAMES.get(abbreviation, abbreviation)
 
         model["radius"] = "> Radius: %.3f deg\n\n" % metadata["radius"]
 
@@ -545,5 +1354,26 @@ class AstroBot:
 
 
 if __name__ == '__main__':
-    bot = AstroBot()
+    parser = argparse.ArgumentParser(description="Reddit bot annotating astrophotographies.")
+    parser.add_argument("--poll-workers", type=int, default=0,
+                        help="number of processes polling Astrometry")
+    parser.add_argument("--annotate-workers", type=int, default=0,
+                        help="number of processes annotating solved images")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus metrics on localhost:PORT/metrics")
+    args = parser.parse_args()
+    if (args.poll_workers > 0) != (args.annotate_workers > 0):
+        parser.error("both kinds of workers are needed")
+
+    socket.setdefaulttimeout(SOCKET_TIMEOUT)
+
+    queue = None
+    if args.poll_workers > 0:
+        queue = WorkQueue(QUEUE_FILE)
+
+    bot = AstroBot(queue, args.poll_workers, args.annotate_workers)
+    if args.metrics_port:
+        bot.metrics.serve(args.metrics_port)
+    if queue is not None:
+        bot.start_workers(args.poll_workers, args.annotate_workers)
     sys.exit(bot.run())
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Rebuild a local dataset of calibrations, tags and image sizes of all the
+submissions in solved.log, fetched from Astrometry.net concurrently.
+The run can be interrupted and resumed, it continues from the last
+checkpoint.
+"""
+
+import argparse
+import itertools
+import sqlite3
+import sys
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import requests
+
+import credentials
+import geometry
+import ratelimit
+import transport
+
+
+API_URL = "http://nova.astrometry.net/api/"
+
+
+class Dataset:
+    """
+    SQLite dataset of the solved submissions.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                            "subid INTEGER PRIMARY KEY, post_id TEXT NOT NULL, status TEXT NOT NULL, "
+                            "job_id INTEGER, image_id INTEGER, ra REAL, dec REAL, radius REAL, "
+                            "pixscale REAL, orientation REAL, parity REAL, width INTEGER, "
+                            "height INTEGER, field REAL, range REAL, constellation TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tags ("
+                            "subid INTEGER NOT NULL, tag TEXT NOT NULL, PRIMARY KEY (subid, tag))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS state ("
+                            "key TEXT PRIMARY KEY, value TEXT)")
+
+    def checkpoint(self):
+        """
+        Return number of lines of the log already processed.
+        """
+        row = self.db.execute("SELECT value FROM state WHERE key = 'line'").fetchone()
+        return int(row[0]) if row is not None else 0
+
+    def failed(self):
+        """
+        Return list of (subid, post_id) whose fetching failed.
+        """
+        return self.db.execute("SELECT subid, post_id FROM jobs WHERE status = 'error'").fetchall()
+
+    def write(self, rows, line=None):
+        """
+        Store the rows and move the checkpoint to the line, in one transaction.
+        """
+        columns = ["subid", "post_id", "status", "job_id", "image_id", "ra", "dec", "radius",
+                   "pixscale", "orientation", "parity", "width", "height", "field", "range",
+                   "constellation"]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO jobs (%s) VALUES (%s)" %
+                                (", ".join(columns), ", ".join("?" * len(columns))),
+                                [[row.get(column) for column in columns] for row in rows])
+            for row in rows:
+                self.db.execute("DELETE FROM tags WHERE subid = ?", (row["subid"],))
+                self.db.executemany("INSERT OR IGNORE INTO tags (subid, tag) VALUES (?, ?)",
+                                    [(row["subid"], tag) for tag in row.get("tags", [])])
+            if line is not None:
+                self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('line', ?)", (line,))
+
+    def close(self):
+        self.db.close()
+
+
+def read_log(path, skip):
+    """
+    Stream (subid, post_id) of the log lines, leaving out the first `skip` lines.
+    """
+    with open(path) as f:
+        for line in itertools.islice(f, skip, None):
+            (subid, _, post_id) = line.strip().partition(":")
+            if subid.isdigit():
+                yield (int(subid), post_id)
+            else:
+                yield None
+
+
+def fetch(http, api_url, subid, post_id):
+    """
+    Fetch the submission and the info of its solved job.
+    """
+    def send_request(service):
+        response = http.post(api_url + service, data={"request-json": "{}"})
+        response.raise_for_status()
+        return response.json()
+
+    row = dict(subid=subid, post_id=post_id)
+    try:
+        submission = send_request("submissions/%d" % subid)
+        if len(submission.get("job_calibrations", [])) == 0:
+            row["status"] = "unsolved"
+            return row
+
+        row["job_id"] = submission["job_calibrations"][0][0]
+        row["image_id"] = submission["user_images"][0] if submission.get("user_images") else None
+        info = send_request("jobs/%d/info" % row["job_id"])
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print "[WARN]:", "Submission %d can't be fetched:" % subid, e
+        row["status"] = "error"
+        return row
+
+    calibration = info.get("calibration") or dict()
+    for key in ["ra", "dec", "radius", "pixscale", "orientation", "parity",
+                "width_arcsec", "height_arcsec"]:
+        row[key] = calibration.get(key)
+    row["tags"] = info.get("tags", [])
+    row["status"] = "solved"
+    return row
+
+
+def derive(rows, constellations=None):
+    """
+    Compute image size, field of view, range and constellation
+    of the whole batch at once.
+    """
+    def column(key):
+        return np.array([row.get(key) for row in rows], dtype=float)
+
+    pixscale = column("pixscale")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        width = np.round(column("width_arcsec") / pixscale)
+        height = np.round(column("height_arcsec") / pixscale)
+        field = geometry.field_of_view(pixscale, width, height)
+        rg = geometry.view_range(field)
+
+    (ra, de) = (column("ra"), column("dec"))
+    names = None
+    if constellations is not None:
+        names = constellations.find(np.nan_to_num(ra), np.nan_to_num(de))
+
+    for (i, row) in enumerate(rows):
+        if not np.isnan(width[i]):
+            row["width"] = int(width[i])
+            row["height"] = int(height[i])
+            row["field"] = float(field[i])
+            row["range"] = float(rg[i])
+        if names is not None and not np.isnan(ra[i]):
+            row["constellation"] = str(names[i])
+    return rows
+
+
+def backfill(args):
+    dataset = Dataset(args.db)
+    http = transport.Session(credentials.USER_AGENT, pool_size=args.workers,
+                             limiter=ratelimit.RateLimiter(ratelimit.SERVICES))
+    pool = ThreadPool(args.workers)
+    constellations = None
+    if args.constellations:
+        constellations = geometry.Constellations.load(args.constellations)
+
+    def process(entries, line=None):
+        rows = pool.map(lambda entry: fetch(http, args.api, *entry), entries)
+        dataset.write(derive(rows, constellations), line)
+        return rows
+
+    if args.retry_errors:
+        rows = process(dataset.failed())
+        print "[INFO]:", "%d failed submission(s) fetched again." % len(rows)
+
+    # the log is read in batches, so only one batch is ever in memory
+    line = dataset.checkpoint()
+    entries = read_log(args.log, line)
+    done = 0
+    while True:
+        batch = list(itertools.islice(entries, args.batch))
+        if not batch:
+            break
+        line += len(batch)
+        rows = process([entry for entry in batch if entry is not None], line)
+        done += len(rows)
+        print "[INFO]:", "%d submission(s) done, %d line(s) of the log processed." % (done, line)
+
+    pool.close()
+    dataset.close()
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--log", default="solved.log", help="log of the solved posts")
+    parser.add_argument("--db", default="backfill.db", help="the dataset")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="number of requests to Astrometry at once")
+    parser.add_argument("--batch", type=int, default=200,
+                        help="number of log lines between two checkpoints")
+    parser.add_argument("--retry-errors", action="store_true",
+                        help="fetch the submissions which failed before again")
+    parser.add_argument("--constellations", help="IAU constellation boundaries (data.dat of CDS VI/42)")
+    parser.add_argument("--api", default=API_URL, help="Astrometry API url")
+    args = parser.parse_args()
+    sys.exit(backfill(args))
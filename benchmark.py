@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks of astrobot against local stand-ins of reddit,
+Astrometry.net, Imgur and the image hosts (see fakes.py).
+
+  poll    polling of many submissions, sequential vs. concurrent
+  replay  replay of a subreddit listing through the whole bot
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import fakes
+from poller import Poller
+
+
+# --- poll
+def bench_poll(args):
+    astrometry = fakes.FakeAstrometry(queued=(0, 0), solve=(0, 0))
+    server = fakes.FakeServer(astrometry, latency=(args.min_latency, args.max_latency)).start()
+    client = fakes.make_client(server.url + "/api/").client.Client()
+
+    import transport
+    http = transport.Session("astrobot benchmark", pool_size=args.workers)
+
+    def send_request(service):
+        return http.post(client.get_url(service), data={"request-json": "{}"}).json()
+
+    subids = [astrometry.request("url_upload", {"url": str(i)})["subid"]
+              for i in range(args.submissions)]
+
+    if not args.skip_sequential:
+        start = time.time()
+        for subid in subids:
+            send_request("submissions/%d" % subid)
+        print "sequential: %.2fs" % (time.time() - start)
+
+    poller = Poller(send_request, args.workers, args.timeout)
+    start = time.time()
+    results = poller.poll(subids)
+    elapsed = time.time() - start
+    poller.close()
+    assert len(results) == len(subids)
+    print "concurrent (%d workers): %.2fs" % (args.workers, elapsed)
+
+    server.shutdown()
+    return 0
+
+
+# --- replay
+SUBREDDITS = ["astrophotography", "astronomy", "space", "spaceporn", "apod"]
+
+TITLES = {
+    "stars": ["Andromeda galaxy from my backyard", "NGC 7000 in HOO",
+              "Milky way over the lake", "Comet over the night sky"],
+    "nebula": ["The Orion nebula", "Heart nebula, 12h", "Rho Ophiuchi nebula complex"],
+    "planet": ["Jupiter and its moons", "Full moon last night", "Saturn at opposition"],
+    "daylight": ["Solar eclipse panorama", "Sunset over the observatory"],
+}
+
+# kinds of images Astrometry solves
+SOLVABLE = ["stars", "nebula"]
+
+COMMENTS = [[], [], ["Wow!"], ["Great shot", "Which scope?"],
+            ["Solved it: http://nova.astrometry.net/user_images/1"]]
+
+
+def synthetic_scenario(posts, seed):
+    """
+    Return scenario of random posts, newest first.
+    """
+    rnd = random.Random(seed)
+    scenario = []
+    for i in range(posts):
+        kind = rnd.choice(["stars"] * 4 + ["nebula"] * 2 + ["planet"] * 2 + ["daylight"])
+        post_id = "p%05d" % i
+        url = "{server}/image/%s.jpg" % post_id
+        if rnd.random() < 0.1:
+            url = "http://imgur.com/a/%s" % post_id
+        scenario.append(dict(id=post_id, title=rnd.choice(TITLES[kind]),
+                             subreddit=rnd.choice(SUBREDDITS), author="user%d" % rnd.randrange(50),
+                             url=url, comments=rnd.choice(COMMENTS),
+                             image=[kind] + list(rnd.choice([(1200, 800), (1600, 1067), (2000, 1333)])),
+                             created=1500000000 + posts - i))
+
+    # cross-posts of older images, the oldest first so that every copy is final
+    for i in reversed(range(posts)):
+        older = [other for other in scenario[i + 1:] if other["image"][0] in SOLVABLE]
+        if older and rnd.random() < 0.15:
+            original = rnd.choice(older)
+            scenario[i]["image"] = original["image"][:3] + [(original["image"] + [original["id"]])[3]]
+            scenario[i]["title"] = original["title"]
+    return scenario
+
+
+def replay(args):
+    if args.scenario:
+        scenario = json.load(open(args.scenario))["posts"]
+    else:
+        scenario = synthetic_scenario(args.posts, args.seed)
+    if args.record:
+        json.dump({"posts": scenario}, open(args.record, "w"), indent=1)
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="astrobot-bench-")
+    os.chdir(workdir)
+
+    # services
+    kinds = dict((spec["id"], spec["image"][0]) for spec in scenario)
+    astrometry = fakes.FakeAstrometry(queued=(args.min_solve / 4, args.max_solve / 4),
+                                      solve=(args.min_solve, args.max_solve),
+                                      outcome=lambda url: kinds.get(url.split("/")[-1].split(".")[0]) in SOLVABLE)
+    images = dict((spec["id"], tuple(spec["image"])) for spec in scenario)
+    server = fakes.FakeServer(astrometry, images, latency=(args.min_latency, args.max_latency)).start()
+    fakes.install(server)
+
+    import __builtin__
+    __builtin__.raw_input = lambda prompt="": "0000"
+
+    import astrobot
+    astrobot.ANNOTATED_URL = server.url + "/annotated_display/%s"
+    astrobot.IMGUR_UPLOAD_URL = server.url + "/imgur/3/image"
+    astrobot.METRICS_FILE = ""
+    astrobot.POLL_INTERVAL = 0.25
+    astrobot.MAX_POLL_INTERVAL = 2
+    astrobot.MIN_CONFIDENCE = args.min_confidence
+
+    reddit = fakes.Reddit
+    reddit.posts = [fakes.Post(reddit, spec["id"], spec["title"],
+                               spec["url"].replace("{server}", server.url), spec["subreddit"],
+                               spec["author"], spec["comments"], spec["created"])
+                    for spec in scenario]
+    results = dict(posts=len(scenario))
+
+    # conditions of all the posts
+    astrobot.STATE_FILE = "filters.db"
+    bot = astrobot.AstroBot()
+    for post in reddit.posts:
+        post.reddit = bot.praw
+    start = time.time()
+    passed = sum(1 for post in reddit.posts if bot._check_condition(post))
+    elapsed = time.time() - start
+    results["passed_filters"] = passed
+    results["filter_posts_per_sec"] = len(scenario) / elapsed
+
+    # the whole pipeline, from crawling to commenting
+    astrobot.STATE_FILE = "pipeline.db"
+    server.calls.clear()
+    bot = astrobot.AstroBot()
+    for post in reddit.posts:
+        post.reddit = bot.praw
+    bot.praw.calls.clear()
+
+    start = time.time()
+    crawled = start
+    bot.process_new()
+    while (bot.solving or bot.solved or bot.edits or bot.praw.hidden) and time.time() - start < args.deadline:
+        bot.rest(0.1)
+        # hidden posts wait for the next loop
+        if time.time() - crawled >= args.cycle:
+            crawled = time.time()
+            bot.process_new()
+    results["pipeline_seconds"] = time.time() - start
+
+    # duplicates are commented without uploading
+    latencies = sorted(bot.praw.commented[post.id] - astrometry.uploaded[post.url]
+                       for post in reddit.posts
+                       if post.id in bot.praw.commented and post.url in astrometry.uploaded)
+    results["submitted"] = len(astrometry.submissions)
+    results["commented"] = len(bot.praw.commented)
+    results["duplicates"] = len(bot.praw.commented) - len(latencies)
+    if astrometry.submissions:
+        results["solve_rate"] = float(len(latencies)) / len(astrometry.submissions)
+    if latencies:
+        results["submit_to_comment_mean"] = sum(latencies) / len(latencies)
+        results["submit_to_comment_median"] = latencies[len(latencies) / 2]
+        results["submit_to_comment_max"] = latencies[-1]
+
+    results["reddit_calls_per_post"] = float(sum(bot.praw.calls.values())) / len(scenario)
+    results["astrometry_calls_per_post"] = float(server.calls["api"]) / len(scenario)
+    results["imgur_calls_per_post"] = float(server.calls["imgur"]) / len(scenario)
+    results["image_calls_per_post"] = float(server.calls["image"] +
+                                            server.calls["annotated_display"]) / len(scenario)
+    results["peak_memory_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    server.shutdown()
+    os.chdir(cwd)
+    shutil.rmtree(workdir)
+    return results
+
+
+# metrics where higher is better, all the others are better lower
+HIGHER_BETTER = ["filter_posts_per_sec", "passed_filters", "submitted", "commented", "duplicates",
+                 "solve_rate"]
+
+
+def report(results, baseline, tolerance):
+    """
+    Print the results compared with the baseline, return number of regressions.
+    """
+    regressions = 0
+    for key in sorted(results):
+        line = "%-28s %12.3f" % (key, results[key])
+        if baseline and key in baseline and baseline[key]:
+            change = (results[key] - baseline[key]) / float(baseline[key])
+            worse = -change if key in HIGHER_BETTER else change
+            line += "  %+7.1f%%" % (change * 100)
+            if key != "posts" and worse > tolerance:
+                line += "  REGRESSION"
+                regressions += 1
+        print line
+    return regressions
+
+
+def bench_replay(args):
+    results = replay(args)
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        baseline = json.load(open(args.baseline))
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.save:
+        json.dump(results, open(args.save, "w"), indent=1, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers()
+
+    poll = subparsers.add_parser("poll", help="polling of many submissions")
+    poll.add_argument("-n", "--submissions", type=int, default=100)
+    poll.add_argument("-w", "--workers", type=int, default=16)
+    poll.add_argument("--min-latency", type=float, default=0.05)
+    poll.add_argument("--max-latency", type=float, default=0.5)
+    poll.add_argument("--timeout", type=float, default=30)
+    poll.add_argument("--skip-sequential", action="store_true")
+    poll.set_defaults(func=bench_poll)
+
+    replay_parser = subparsers.add_parser("replay", help="replay of posts through the bot")
+    replay_parser.add_argument("-n", "--posts", type=int, default=40,
+                               help="number of synthetic posts")
+    replay_parser.add_argument("--seed", type=int, default=0)
+    replay_parser.add_argument("--scenario", help="replay recorded posts from JSON file")
+    replay_parser.add_argument("--record", help="save the replayed posts to JSON file")
+    replay_parser.add_argument("--min-latency", type=float, default=0.01)
+    replay_parser.add_argument("--max-latency", type=float, default=0.1)
+    replay_parser.add_argument("--min-solve", type=float, default=0.5)
+    replay_parser.add_argument("--max-solve", type=float, default=3)
+    replay_parser.add_argument("--min-confidence", type=float, default=0.5,
+                               help="images less likely to be star fields are not uploaded")
+    replay_parser.add_argument("--cycle", type=float, default=2,
+                               help="time between two loops of the bot")
+    replay_parser.add_argument("--deadline", type=float, default=600,
+                               help="give up waiting for the comments after n seconds")
+    replay_parser.add_argument("--baseline", help="compare with results saved by a previous run")
+    replay_parser.add_argument("--save", help="save the results to JSON file")
+    replay_parser.add_argument("--tolerance", type=float, default=0.1,
+                               help="relative change reported as regression")
+    replay_parser.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
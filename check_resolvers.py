@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Check the link resolvers offline: saved pages of the supported hosts
+(corpus/) and imgur links are fed through default_resolver, and the
+direct image urls it returns are compared with the expected ones.
+Exits with non-zero status if any of them differs.
+"""
+
+import os
+import sys
+
+import resolvers
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+# link -> (saved page served for the link's page url or None, expected direct url)
+CASES = [
+    # imgur: direct links are built without network access
+    ("http://imgur.com/Xy3aB9c", None, "http://i.imgur.com/Xy3aB9c.jpg"),
+    ("https://imgur.com/gallery/Xy3aB9c", None, "https://i.imgur.com/Xy3aB9c.jpg"),
+    ("http://imgur.com/Xy3aB9c/new", None, "http://i.imgur.com/Xy3aB9c.jpg"),
+    ("http://i.imgur.com/Xy3aB9c", None, "http://i.imgur.com/Xy3aB9c.jpg"),
+    ("http://i.imgur.com/Xy3aB9c.png", None, "http://i.imgur.com/Xy3aB9c.png"),
+    ("http://imgur.com/a/Qw12E", None, None),
+    ("http://imgur.com/Xy3aB9c,Zz9yY8x", None, None),
+    ("http://i.imgur.com/Xy3aB9c.gifv", None, None),
+
+    # flickr: the large size of the photo
+    ("https://www.flickr.com/photos/stargazer/12345678901/in/dateposted/",
+     ("https://www.flickr.com/photos/stargazer/12345678901/sizes/l", "flickr_sizes_l.html"),
+     "https://c1.staticflickr.com/8/7414/12345678901_0a1b2c3d4e_b.jpg"),
+    ("https://www.flickr.com/photos/stargazer/", None, None),
+
+    # apod: the image shown on the page
+    ("http://apod.nasa.gov/apod/ap170101.html",
+     ("http://apod.nasa.gov/apod/ap170101.html", "apod.html"),
+     "http://apod.nasa.gov/apod/image/1701/NGC3372_Pavlov1024.jpg"),
+
+    # wikipedia: the full resolution file, current and older page layout
+    ("https://en.wikipedia.org/wiki/File:Orion_Nebula_-_Hubble_2006_mosaic_18000.jpg",
+     ("https://en.wikipedia.org/wiki/File:Orion_Nebula_-_Hubble_2006_mosaic_18000.jpg",
+      "wikipedia_file.html"),
+     "http://upload.wikimedia.org/wikipedia/commons/f/f3/Orion_Nebula_-_Hubble_2006_mosaic_18000.jpg"),
+    ("http://en.wikipedia.org/wiki/File:Andromeda_Galaxy_(with_h-alpha).jpg",
+     ("http://en.wikipedia.org/wiki/File:Andromeda_Galaxy_(with_h-alpha).jpg",
+      "wikipedia_file_old.html"),
+     "http://upload.wikimedia.org/wikipedia/commons/9/98/Andromeda_Galaxy_%28with_h-alpha%29.jpg"),
+    ("https://en.wikipedia.org/wiki/Orion_Nebula", None, None),
+]
+
+
+class Response:
+    def __init__(self, content):
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, size):
+        for i in range(0, len(self.content), size):
+            yield self.content[i:i + size]
+
+    def close(self):
+        pass
+
+
+class StubHTTP:
+    """
+    Serve the saved pages, fail on any other url.
+    """
+    def __init__(self, pages):
+        self.pages = pages
+
+    def download(self, url, **kwargs):
+        if url not in self.pages:
+            raise AssertionError("unexpected request of " + url)
+        with open(os.path.join(CORPUS, self.pages[url])) as f:
+            return Response(f.read())
+
+
+def check():
+    pages = dict(page for (_, page, _) in CASES if page is not None)
+    resolver = resolvers.default_resolver(StubHTTP(pages), ttl=0, failed_ttl=0)
+
+    failures = 0
+    for (link, _, expected) in CASES:
+        try:
+            result = resolver.resolve(link)
+        except AssertionError as e:
+            result = "error: %s" % e
+        if result != expected:
+            print "FAIL %s\n  expected %s\n  got      %s" % (link, expected, result)
+            failures += 1
+        elif resolver.supports(link) != (expected is not None):
+            print "FAIL %s\n  supports() disagrees with resolve()" % link
+            failures += 1
+
+    print "%d of %d link(s) resolved as expected." % (len(CASES) - failures, len(CASES))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(check())
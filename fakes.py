@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+"""
+Local stand-ins for reddit (praw), Astrometry.net (client) and Imgur
+(pyimgur) used by the offline benchmarks. Astrometry, Imgur and the
+image hosts are served by FakeServer over HTTP, so the bot talks to
+them through its real HTTP stack; praw is replaced in process.
+"""
+
+import io
+import json
+import random
+import threading
+import time
+import types
+import urlparse
+from collections import Counter
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+# --- synthetic images
+def star_field(width, height, stars=300, seed=0):
+    """
+    Dark image with point-like stars.
+    """
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(seed)
+    image = Image.new("RGB", (width, height), (8, 8, 16))
+    draw = ImageDraw.Draw(image)
+    for _ in range(stars):
+        (x, y) = (rnd.randrange(width), rnd.randrange(height))
+        r = rnd.choice([0, 0, 0, 1, 1, 2])
+        v = rnd.randrange(120, 256)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=(v, v, v))
+    return image
+
+
+def nebula(width, height, seed=0):
+    """
+    Star field over a bright nebula filling the frame.
+    """
+    import numpy as np
+    from PIL import Image, ImageChops
+
+    # the glow is smooth, so it's drawn small and stretched
+    rnd = random.Random(seed)
+    brightness = rnd.uniform(80, 160)
+    (y, x) = np.mgrid[-1:1:64j, -1:1:64j]
+    glow = brightness * (0.4 + np.exp(-(x / 1.2) ** 2 - (y / 1.2) ** 2))
+    glow = glow[..., np.newaxis] * np.array([1.0, 0.5, 0.6])
+    glow = Image.fromarray(np.clip(glow, 0, 255).astype(np.uint8)).resize((width, height), Image.BILINEAR)
+    return ImageChops.add(star_field(width, height, seed=seed), glow)
+
+
+def planet(width, height, seed=0):
+    """
+    Dark image with a single bright disc, e.g. the Moon.
+    """
+    from PIL import Image, ImageDraw
+
+    rnd = random.Random(seed)
+    image = Image.new("RGB", (width, height), (0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    r = min(width, height) * rnd.uniform(0.2, 0.4)
+    (x, y) = (width / 2, height / 2)
+    draw.ellipse((x - r, y - r, x + r, y + r), fill=(200, 200, 190))
+    return image
+
+
+def daylight(width, height, seed=0):
+    """
+    Bright image without stars, e.g. a landscape.
+    """
+    from PIL import Image
+
+    rnd = random.Random(seed)
+    return Image.new("RGB", (width, height), (rnd.randrange(100, 160), 170, 230))
+
+
+IMAGE_KINDS = {"stars": star_field, "nebula": nebula, "planet": planet, "daylight": daylight}
+
+
+def encode(image, fmt="JPEG"):
+    data = io.BytesIO()
+    image.save(data, fmt, quality=90)
+    return data.getvalue()
+
+
+# --- HTTP server of Astrometry, Imgur and images
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.count(self.path)
+        path = urlparse.urlparse(self.path).path
+        if path.startswith("/image/"):
+            self._image(path.split("/")[-1].split(".")[0])
+        elif path.startswith("/annotated_display/"):
+            self._send(200, self.server.annotated, "image/png")
+        else:
+            self._send(404, "", "text/plain")
+
+    def do_POST(self):
+        self.server.count(self.path)
+        body = self.rfile.read(int(self.headers.getheader("content-length", 0)))
+        path = urlparse.urlparse(self.path).path
+        time.sleep(random.uniform(*self.server.latency))
+
+        if path.startswith("/api/"):
+            args = urlparse.parse_qs(body).get("request-json", ["{}"])[0]
+            result = self.server.astrometry.request(path[len("/api/"):], json.loads(args))
+            self._send(200, json.dumps(result), "application/json")
+        elif path.startswith("/imgur/"):
+            self.server.uploads += 1
+            link = "http://i.imgur.example/%d.png" % self.server.uploads
+            self._send(200, json.dumps({"data": {"id": str(self.server.uploads), "link": link},
+                                        "success": True, "status": 200}), "application/json")
+        else:
+            self._send(404, "", "text/plain")
+
+    def _image(self, name):
+        data = self.server.image(name)
+        if data is None:
+            self._send(404, "", "text/plain")
+            return
+
+        status = 200
+        byte_range = self.headers.getheader("range")
+        if byte_range and byte_range.startswith("bytes="):
+            (start, end) = byte_range[len("bytes="):].split("-")
+            data = data[int(start):int(end) + 1]
+            status = 206
+        self._send(status, data, "image/jpeg")
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """
+    Serve images, the Astrometry API, annotated images and Imgur uploads.
+    images is dict name -> (kind, width, height[, seed]), images with
+    the same seed look the same, e.g. cross-posts.
+    """
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, astrometry, images=None, latency=(0, 0)):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeHandler)
+        self.astrometry = astrometry
+        self.images = images or dict()
+        self.latency = latency
+        self.uploads = 0
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.cache = dict()
+        self.annotated = encode(star_field(400, 300), "PNG")
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def count(self, path):
+        kind = urlparse.urlparse(path).path.strip("/").split("/")[0]
+        with self.lock:
+            self.calls[kind] += 1
+
+    def image(self, name):
+        with self.lock:
+            if name not in self.cache:
+                if name not in self.images:
+                    return None
+                (kind, width, height) = self.images[name][:3]
+                seed = self.images[name][3] if len(self.images[name]) > 3 else name
+                self.cache[name] = encode(IMAGE_KINDS[kind](width, height, seed=hash(seed)))
+            return self.cache[name]
+
+    def handle_error(self, request, client_address):
+        # clients drop connections, e.g. after reading the image header
+        pass
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class FakeAstrometry:
+    """
+    Job lifecycle of nova.astrometry.net: a job is started `queued`
+    seconds after the upload and solved (or failed) `solve` seconds later.
+    Images are solved or failed according to `outcome(url)`.
+    """
+    def __init__(self, queued=(0.1, 0.5), solve=(0.5, 3), outcome=None):
+        self.queued = queued
+        self.solve = solve
+        self.outcome = outcome or (lambda url: True)
+        self.lock = threading.Lock()
+        self.submissions = dict()
+        # url -> time of upload
+        self.uploaded = dict()
+
+    def request(self, service, args):
+        parts = service.strip("/").split("/")
+        with self.lock:
+            if parts[0] == "login":
+                return {"status": "success", "session": "fake"}
+            if parts[0] in ("url_upload", "upload"):
+                return self._upload(args)
+            if parts[0] == "submissions":
+                return self._submission(int(parts[1]))
+            if parts[0] == "jobs":
+                return self._job(int(parts[1]), parts[2] if len(parts) > 2 else None)
+        return {"status": "error", "errormessage": "unknown service " + service}
+
+    def _upload(self, args):
+        subid = len(self.submissions) + 1
+        url = args.get("url", "file:%d" % subid)
+        now = time.time()
+        started = now + random.uniform(*self.queued)
+        self.submissions[subid] = dict(url=url, started=started,
+                                       finished=started + random.uniform(*self.solve),
+                                       solved=self.outcome(url))
+        self.uploaded[url] = now
+        return {"status": "success", "subid": subid}
+
+    def _submission(self, subid):
+        submission = self.submissions[subid]
+        now = time.time()
+        result = {"jobs": [], "job_calibrations": [], "user_images": []}
+        if now >= submission["started"]:
+            result["jobs"] = [subid]
+            result["user_images"] = [subid]
+        if now >= submission["finished"] and submission["solved"]:
+            result["job_calibrations"] = [[subid, subid]]
+        return result
+
+    def _job(self, job_id, detail):
+        submission = self.submissions[job_id]
+        rnd = random.Random(job_id)
+        if detail == "calibration":
+            return {"ra": rnd.uniform(0, 360), "dec": rnd.uniform(-90, 90),
+                    "radius": rnd.uniform(0.1, 20), "pixscale": rnd.uniform(0.5, 60),
+                    "orientation": 0, "parity": 1}
+        if detail == "tags":
+            return {"tags": rnd.sample(["M 31", "NGC 7000", "The star Vega", "Orion Nebula",
+                                        "IC 434", "The star Deneb", "M 42"], 3)}
+        if detail == "info":
+            calibration = self._job(job_id, "calibration")
+            calibration["width_arcsec"] = calibration["pixscale"] * 1200
+            calibration["height_arcsec"] = calibration["pixscale"] * 800
+            return {"status": "success" if submission["solved"] else "failure",
+                    "calibration": calibration, "tags": self._job(job_id, "tags")["tags"]}
+
+        if time.time() < submission["finished"]:
+            return {"status": "solving"}
+        return {"status": "success" if submission["solved"] else "failure"}
+
+
+# --- praw
+class APIException(Exception):
+    pass
+
+
+class RateLimitExceeded(APIException):
+    def __init__(self, sleep_time):
+        APIException.__init__(self, "you are doing that too much")
+        self.sleep_time = sleep_time
+
+
+class Redditor:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.name = name
+
+    def get_comments(self, limit=None):
+        self.reddit.call("get_comments")
+        comments = [c for c in reversed(self.reddit.comments) if c.author.name == self.name]
+        return comments[:limit]
+
+    def __eq__(self, other):
+        return isinstance(other, Redditor) and other.name.lower() == self.name.lower()
+
+
+class Subreddit:
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+class Comment:
+    def __init__(self, reddit, comment_id, body, author, submission):
+        self.reddit = reddit
+        self.id = comment_id
+        self.fullname = "t1_" + comment_id
+        self.body = body
+        self.author = author
+        self.submission = submission
+        self.link_id = submission.fullname
+
+    def edit(self, body):
+        self.reddit.call("edit")
+        self.body = body
+
+    def delete(self):
+        self.reddit.call("delete")
+        self.reddit.comments.remove(self)
+
+
+class MoreComments:
+    pass
+
+
+class Post:
+    def __init__(self, reddit, post_id, title, url, subreddit, author, comments=(), created=0):
+        self.reddit = reddit
+        self.id = post_id
+        self.fullname = "t3_" + post_id
+        self.title = title
+        self.url = url
+        self.subreddit = Subreddit(subreddit)
+        self.author = Redditor(reddit, author)
+        self.permalink = "https://reddit.example/r/%s/comments/%s" % (subreddit, post_id)
+        self.created_utc = created
+        self.saved = False
+        self._comments = [Comment(reddit, "%s_%d" % (post_id, i), body, Redditor(reddit, "someone"), self)
+                          for (i, body) in enumerate(comments)]
+
+    @property
+    def comments(self):
+        self.reddit.call("comments")
+        return list(self._comments)
+
+    def add_comment(self, body):
+        self.reddit.call("add_comment")
+        c = Comment(self.reddit, "c%d" % (len(self.reddit.comments) + 1), body,
+                    Redditor(self.reddit, self.reddit.user.name), self)
+        self._comments.append(c)
+        self.reddit.comments.append(c)
+        self.reddit.commented[self.id] = time.time()
+        return c
+
+    def upvote(self):
+        self.reddit.call("upvote")
+
+    def save(self):
+        self.reddit.call("save")
+        self.saved = True
+
+    def hide(self):
+        self.reddit.call("hide")
+        if self not in self.reddit.hidden:
+            self.reddit.hidden.append(self)
+
+    def unhide(self):
+        self.reddit.call("unhide")
+        if self in self.reddit.hidden:
+            self.reddit.hidden.remove(self)
+
+
+class Listing:
+    def __init__(self, reddit):
+        self.reddit = reddit
+
+    def get_new(self, limit=100, params=None):
+        """
+        Posts newest first; with params["before"] only posts newer than it.
+        """
+        self.reddit.call("get_new")
+        posts = self.reddit.posts
+        before = (params or dict()).get("before")
+        if before is not None:
+            fullnames = [post.fullname for post in posts]
+            if before not in fullnames:
+                return []
+            newer = posts[:fullnames.index(before)]
+            return newer[-limit:]
+        return posts[:limit]
+
+
+class User:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.name = name
+
+    def get_hidden(self):
+        self.reddit.call("get_hidden")
+        return list(self.reddit.hidden)
+
+
+class Reddit:
+    """
+    In-process reddit serving `posts` (newest first) and counting the API calls.
+    """
+    posts = []
+
+    def __init__(self, user_agent=None, **kwargs):
+        import requests
+
+        self.http = requests.Session()
+        self.calls = Counter()
+        self.comments = []
+        # post id -> time of the comment
+        self.commented = dict()
+        self.hidden = []
+        self.user = User(self, "astro-bot")
+        Reddit.instances.append(self)
+
+    instances = []
+
+    def call(self, name):
+        self.calls[name] += 1
+
+    def login(self, username=None, password=None, **kwargs):
+        self.call("login")
+        self.user = User(self, username)
+
+    def get_subreddit(self, name):
+        return Listing(self)
+
+    def get_redditor(self, name):
+        return Redditor(self, name)
+
+    def get_inbox(self, *args, **kwargs):
+        self.call("get_inbox")
+        return []
+
+    def get_info(self, thing_id=None, **kwargs):
+        self.call("get_info")
+        things = dict((post.fullname, post) for post in self.posts)
+        things.update((c.fullname, c) for c in self.comments)
+        return [things[t] for t in thing_id if t in things]
+
+    def send_message(self, *args, **kwargs):
+        self.call("send_message")
+
+
+def flatten_tree(comments):
+    return list(comments)
+
+
+def make_praw():
+    praw = types.ModuleType("praw")
+    praw.Reddit = Reddit
+    praw.helpers = types.ModuleType("praw.helpers")
+    praw.helpers.flatten_tree = flatten_tree
+    praw.objects = types.ModuleType("praw.objects")
+    praw.objects.Comment = Comment
+    praw.objects.MoreComments = MoreComments
+    praw.errors = types.ModuleType("praw.errors")
+    praw.errors.APIException = APIException
+    praw.errors.RateLimitExceeded = RateLimitExceeded
+    return praw
+
+
+# --- astrometry client
+class RequestError(Exception):
+    pass
+
+
+def make_client(apiurl):
+    class Client(object):
+        def __init__(self, apiurl=apiurl):
+            self.apiurl = apiurl
+            self.session = None
+
+        def get_url(self, service):
+            return self.apiurl + service
+
+        def send_request(self, service, args={}, file_args=None):
+            raise NotImplementedError("only requests through the shared session are faked")
+
+        def login(self, apikey):
+            result = self.send_request("login", {"apikey": apikey})
+            self.session = result["session"]
+
+        def url_upload(self, url, **kwargs):
+            args = dict(kwargs)
+            args["url"] = url
+            return self.send_request("url_upload", args)
+
+        def upload(self, fn=None, **kwargs):
+            return self.send_request("upload", dict(kwargs))
+
+    client = types.ModuleType("client")
+    client.client = types.ModuleType("client.client")
+    client.client.Client = Client
+    client.client.RequestError = RequestError
+    return client
+
+
+# --- pyimgur
+class Imgur:
+    def __init__(self, client_id, client_secret=None, **kwargs):
+        self.client_id = client_id
+        self.access_token = "token"
+        self.refresh_token = "refresh"
+        self.refreshed = 0
+
+    def exchange_pin(self, pin):
+        return (self.access_token, self.refresh_token)
+
+    def refresh_access_token(self):
+        self.refreshed += 1
+        return self.access_token
+
+
+class Image:
+    def __init__(self, data, imgur):
+        self.id = data["id"]
+        self.link = data["link"]
+
+
+def make_pyimgur():
+    pyimgur = types.ModuleType("pyimgur")
+    pyimgur.Imgur = Imgur
+    pyimgur.Image = Image
+    return pyimgur
+
+
+def make_credentials():
+    credentials = types.ModuleType("credentials")
+    credentials.USER_AGENT = "astrobot benchmark"
+    credentials.IMGUR_CLIENT_ID = "id"
+    credentials.IMGUR_CLIENT_SECRET = "secret"
+    credentials.IMGUR_AUTH_URL = "http://imgur.example/auth"
+    credentials.ALBUM_ID = "album"
+    credentials.ASTROMETRY_ID = "key"
+    credentials.REDDIT_USER = "astro-bot"
+    credentials.REDDIT_PASSWORD = "password"
+    return credentials
+
+
+def install(server):
+    """
+    Replace the service modules imported by astrobot with the stand-ins.
+    Must be called before astrobot is imported.
+    """
+    import sys
+
+    sys.modules["praw"] = make_praw()
+    sys.modules["client"] = make_client(server.url + "/api/")
+    sys.modules["pyimgur"] = make_pyimgur()
+    sys.modules["credentials"] = make_credentials()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import io
+
+from PIL import Image
+
+
+HASH_SIZE = 8     # the hash compares HASH_SIZE x HASH_SIZE cells
+DRAFT_SIZE = 64   # JPEG is decoded at the smallest scale at least this big
+
+
+def dhash(data):
+    """
+    Difference hash of the image data: which of every two neighbouring
+    cells of a tiny grayscale thumbnail is brighter. Resized or
+    recompressed copies of an image have hashes differing in few bits.
+    Return the hash as hex string.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.draft("L", (DRAFT_SIZE, DRAFT_SIZE))
+
+    # float cells, so that faint gradients of dark images are not lost by rounding
+    image = image.convert("L").convert("F").resize((HASH_SIZE + 1, HASH_SIZE), Image.ANTIALIAS)
+    pixels = list(image.getdata())
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            i = row * (HASH_SIZE + 1) + col
+            value = (value << 1) | (pixels[i] > pixels[i + 1])
+    return "%0*x" % (HASH_SIZE * HASH_SIZE / 4, value)
+
+
+def distance(a, b):
+    """
+    Number of bits in which the two hashes differ.
+    """
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def informative(h):
+    """
+    Decide whether the hash tells the image apart from others,
+    hashes of flat images are (almost) all zeros.
+    """
+    ones = bin(int(h, 16)).count("1")
+    return HASH_SIZE < ones < HASH_SIZE * HASH_SIZE - HASH_SIZE
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Sky geometry of solved images. All the functions take and return NumPy
+arrays (scalars work too), so thousands of jobs are processed at once.
+Angles are in degrees unless said otherwise.
+"""
+
+import numpy as np
+
+
+RADIUS_EARTH = 6378135.0        # in meters
+VIEWABLE_ANGULAR_SCALE = 50.0   # field of view of the sky viewers, in degrees
+TINY_FLOAT_VALUE = 1.0e-8
+
+
+def field_of_view(pixscale, width, height):
+    """
+    Angular size of the longer side of the image,
+    pixscale is in arcseconds per pixel.
+    """
+    return np.asarray(pixscale, dtype=float) * np.maximum(width, height) / 3600.0
+
+
+def view_range(field):
+    """
+    Distance from which the sky viewers show the field of view, in meters.
+    """
+    alpha = np.radians(0.5 * VIEWABLE_ANGULAR_SCALE)
+    beta = np.minimum(np.radians(0.5 * np.asarray(field, dtype=float)), alpha)
+    return RADIUS_EARTH * (1.0 - np.sin(alpha - beta) / (np.sin(alpha) + TINY_FLOAT_VALUE))
+
+
+def sexagesimal(values, decimals=2, wrap=None):
+    """
+    Split the values into (sign, units, minutes, seconds), sign being
+    -1 or 1, so that e.g. -0.5 is -0 30' and not 0 30'. Seconds are
+    rounded to the decimals first, so they never show as 60, and units
+    are taken modulo wrap, so that hours of RA never show as 24.
+
+    >>> [float(x) for x in sexagesimal(23.99999999, wrap=24)]
+    [1.0, 0.0, 0.0, 0.0]
+    >>> [float(x) for x in sexagesimal(-0.5)]
+    [-1.0, 0.0, 30.0, 0.0]
+    """
+    values = np.asarray(values, dtype=float)
+    sign = np.where(values < 0, -1, 1)
+    seconds = np.round(np.abs(values) * 3600.0, decimals)
+    units = np.floor(seconds / 3600.0)
+    seconds -= units * 3600.0
+    minutes = np.floor(seconds / 60.0)
+    seconds -= minutes * 60.0
+    if wrap is not None:
+        units %= wrap
+    return (sign, units.astype(int), minutes.astype(int), seconds)
+
+
+def _zoom(rg, base):
+    # round half away from zero, like the original scalar code
+    levels = np.log2(np.asarray(rg, dtype=float) / 90.0)
+    return (base - np.sign(levels) * np.floor(np.abs(levels) + 0.5)).astype(int)
+
+
+def wikisky_zoom(rg):
+    return _zoom(rg, 18)
+
+
+def googlesky_zoom(rg):
+    return _zoom(rg, 20)
+
+
+# --- constellations
+def precess(ra, de, year):
+    """
+    Precess J2000 coordinates to the equinox of the year (IAU 1976 precession).
+    """
+    t = (year - 2000.0) / 100.0
+    zeta = np.radians((2306.2181 * t + 0.30188 * t ** 2 + 0.017998 * t ** 3) / 3600.0)
+    z = np.radians((2306.2181 * t + 1.09468 * t ** 2 + 0.018203 * t ** 3) / 3600.0)
+    theta = np.radians((2004.3109 * t - 0.42665 * t ** 2 - 0.041833 * t ** 3) / 3600.0)
+
+    ra = np.radians(np.asarray(ra, dtype=float)) + zeta
+    de = np.radians(np.asarray(de, dtype=float))
+    a = np.cos(de) * np.sin(ra)
+    b = np.cos(theta) * np.cos(de) * np.cos(ra) - np.sin(theta) * np.sin(de)
+    c = np.sin(theta) * np.cos(de) * np.cos(ra) + np.cos(theta) * np.sin(de)
+    return (np.degrees(np.arctan2(a, b) + z) % 360.0, np.degrees(np.arcsin(np.clip(c, -1, 1))))
+
+
+class Constellations:
+    """
+    Constellation of sky coordinates by the IAU boundaries, which follow
+    the lines of constant RA and Dec of the 1875 equinox (Roman, 1987).
+
+    The boundary table is turned into a grid whose edges are all the
+    distinct RA and Dec values of the table, so that a lookup is two
+    binary searches.
+    """
+    EQUINOX = 1875.0
+
+    def __init__(self, boundaries):
+        """
+        boundaries is list of (RA low, RA high in hours, Dec low, abbreviation)
+        ordered as in the table: the first one containing a point wins.
+        """
+        ra_low = np.array([row[0] for row in boundaries], dtype=float) * 15.0
+        ra_high = np.array([row[1] for row in boundaries], dtype=float) * 15.0
+        de_low = np.array([row[2] for row in boundaries], dtype=float)
+        self.names = sorted(set(row[3] for row in boundaries))
+        index = np.array([self.names.index(row[3]) for row in boundaries])
+
+        self.ra_edges = np.unique(np.concatenate([ra_low, ra_high, [0.0, 360.0]]))
+        self.de_edges = np.unique(np.concatenate([de_low, [-90.0, 90.0]]))
+
+        # classify the centre of every cell, the first row wins
+        ra = (self.ra_edges[:-1] + self.ra_edges[1:]) / 2.0
+        de = (self.de_edges[:-1] + self.de_edges[1:]) / 2.0
+        (ra, de) = np.meshgrid(ra, de, indexing="ij")
+        self.grid = np.full(ra.shape, -1, dtype=np.int16)
+        for i in reversed(range(len(boundaries))):
+            inside = (ra >= ra_low[i]) & (ra < ra_high[i]) & (de >= de_low[i])
+            self.grid[inside] = index[i]
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the boundaries from file with the lines of the table
+        (e.g. data.dat of catalogue VI/42 of CDS).
+        """
+        boundaries = []
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 4:
+                    boundaries.append((float(fields[0]), float(fields[1]), float(fields[2]),
+                                       fields[3].upper()))
+        return cls(boundaries)
+
+    def find(self, ra, de):
+        """
+        Return array of abbreviations of the constellations of J2000 coordinates.
+        """
+        (ra, de) = precess(ra, de, self.EQUINOX)
+        i = np.clip(np.searchsorted(self.ra_edges, ra, side="right") - 1, 0, len(self.ra_edges) - 2)
+        j = np.clip(np.searchsorted(self.de_edges, de, side="right") - 1, 0, len(self.de_edges) - 2)
+        names = np.array(self.names + [""])
+        return names[self.grid[i, j]]
+
+
+NAMES = {
+    "AND": "Andromeda", "ANT": "Antlia", "APS": "Apus", "AQR": "Aquarius", "AQL": "Aquila",
+    "ARA": "Ara", "ARI": "Aries", "AUR": "Auriga", "BOO": "Bootes", "CAE": "Caelum",
+    "CAM": "Camelopardalis", "CNC": "Cancer", "CVN": "Canes Venatici", "CMA": "Canis Major",
+    "CMI": "Canis Minor", "CAP": "Capricornus", "CAR": "Carina", "CAS": "Cassiopeia",
+    "CEN": "Centaurus", "CEP": "Cepheus", "CET": "Cetus", "CHA": "Chamaeleon", "CIR": "Circinus",
+    "COL": "Columba", "COM": "Coma Berenices", "CRA": "Corona Australis", "CRB": "Corona Borealis",
+    "CRV": "Corvus", "CRT": "Crater", "CRU": "Crux", "CYG": "Cygnus", "DEL": "Delphinus",
+    "DOR": "Dorado", "DRA": "Draco", "EQU": "Equuleus", "ERI": "Eridanus", "FOR": "Fornax",
+    "GEM": "Gemini", "GRU": "Grus", "HER": "Hercules", "HOR": "Horologium", "HYA": "Hydra",
+    "HYI": "Hydrus", "IND": "Indus", "LAC": "Lacerta", "LEO": "Leo", "LMI": "Leo Minor",
+    "LEP": "Lepus", "LIB": "Libra", "LUP": "Lupus", "LYN": "Lynx", "LYR": "Lyra",
+    "MEN": "Mensa", "MIC": "Microscopium", "MON": "Monoceros", "MUS": "Musca", "NOR": "Norma",
+    "OCT": "Octans", "OPH": "Ophiuchus", "ORI": "Orion", "PAV": "Pavo", "PEG": "Pegasus",
+    "PER": "Perseus", "PHE": "Phoenix", "PIC": "Pictor", "PSC": "Pisces", "PSA": "Piscis Austrinus",
+    "PUP": "Puppis", "PYX": "Pyxis", "RET": "Reticulum", "SGE": "Sagitta", "SGR": "Sagittarius",
+    "SCO": "Scorpius", "SCL": "Sculptor", "SCT": "Scutum", "SER": "Serpens", "SEX": "Sextans",
+    "TAU": "Taurus", "TEL": "Telescopium", "TRI": "Triangulum", "TRA": "Triangulum Australe",
+    "TUC": "Tucana", "UMA": "Ursa Major", "UMI": "Ursa Minor", "VEL": "Vela", "VIR": "Virgo",
+    "VOL": "Volans", "VUL": "Vulpecula",
+}
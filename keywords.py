@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import re
+
+
+# blacklist of words on /r/astrophotography+apod
+BLACKLIST = ["moon", "lunar", "sun", "solar", "eclipse",
+             "mercury", "venus", "mars", "jupiter", "saturn", "uranus",
+             "neptune", "trail", "panorama",
+             # compounds which substring matching used to catch
+             "startrail", "supermoon", "moonrise", "moonset", "moonlight",
+             "sunspot", "halfmoon"]
+
+# whitelist of words on /r/astronomy+space+spaceporn
+WHITELIST = ["galaxy", "galaxies", "ngc", "comet", "nebula", "constellation",
+             "iss", "ison", "sky", "skies"]
+
+
+class KeywordMatcher:
+    """
+    Count the words of several keyword lists found in a text in a single pass.
+    Only whole words match (plurals and catalogue numbers like "ngc7000"
+    included), so "sun" doesn't match "sunset".
+    """
+    def __init__(self, **lists):
+        self.names = lists.keys()
+        self.owners = dict()
+        for (name, words) in lists.items():
+            for word in words:
+                self.owners.setdefault(word.lower(), set()).add(name)
+
+        # longer words first, so that the longest keyword wins
+        words = sorted(self.owners, key=len, reverse=True)
+        self.pattern = re.compile(r"\b(%s)(?:s|es|\d+)?\b" % "|".join(map(re.escape, words)),
+                                  re.IGNORECASE | re.UNICODE)
+
+    def count(self, text):
+        """
+        Return dict of list name -> number of distinct words found.
+        """
+        found = set(match.group(1).lower() for match in self.pattern.finditer(text))
+
+        counts = dict((name, 0) for name in self.names)
+        for word in found:
+            for name in self.owners[word]:
+                counts[name] += 1
+        return counts
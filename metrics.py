@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms of the bot. Updating them
+    costs a dict lookup under a lock, so they can always stay on.
+    Exported as Prometheus text or JSON.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = dict()
+        self.gauges = dict()
+        # (name, labels) -> [count in every bucket..., sum, count]
+        self.histograms = dict()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            for (i, bound) in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """
+        Measure duration of the block as histogram `name`_seconds and
+        count its exceptions by type as `name`_errors_total.
+        """
+        start = time.time()
+        try:
+            yield
+        except Exception as e:
+            self.inc(name + "_errors_total", type=type(e).__name__, **labels)
+            raise
+        finally:
+            self.observe(name + "_seconds", time.time() - start, **labels)
+
+    # --- export
+    def prometheus(self):
+        """
+        Return the metrics in Prometheus text format.
+        """
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for (k, v) in labels)
+
+        lines = []
+        with self.lock:
+            for ((name, labels), value) in sorted(self.counters.items()):
+                lines.append("%s%s %s" % (name, format_labels(labels), value))
+            for ((name, labels), value) in sorted(self.gauges.items()):
+                lines.append("%s%s %s" % (name, format_labels(labels), value))
+            for ((name, labels), histogram) in sorted(self.histograms.items()):
+                for (i, bound) in enumerate(BUCKETS):
+                    lines.append("%s_bucket%s %d" % (name, format_labels(labels, [("le", bound)]),
+                                                     histogram[i]))
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels, [("le", "+Inf")]),
+                                                 histogram[-1]))
+                lines.append("%s_sum%s %f" % (name, format_labels(labels), histogram[-2]))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), histogram[-1]))
+        return "\n".join(lines) + "\n"
+
+    def json(self):
+        """
+        Return the metrics as dict which can be dumped to JSON.
+        """
+        def entries(items, value):
+            return [dict(name=name, labels=dict(labels), **value(v)) for ((name, labels), v) in sorted(items)]
+
+        with self.lock:
+            return dict(
+                time=time.time(),
+                counters=entries(self.counters.items(), lambda v: dict(value=v)),
+                gauges=entries(self.gauges.items(), lambda v: dict(value=v)),
+                histograms=entries(self.histograms.items(),
+                                   lambda h: dict(buckets=dict(zip(map(str, BUCKETS), h[:-2])),
+                                                  sum=h[-2], count=h[-1])))
+
+    def dump(self, path):
+        """
+        Write the metrics to JSON file, replacing it atomically.
+        """
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.json(), f, indent=1)
+        os.rename(tmp, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Serve the metrics in Prometheus format on http://host:port/metrics
+        from a background thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
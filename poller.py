@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+from multiprocessing.pool import ThreadPool
+import time
+
+
+class Poller:
+    """
+    Poll the status of many Astrometry submissions concurrently.
+    """
+    def __init__(self, send_request, workers, timeout):
+        """
+        send_request is the Astrometry client call (service -> dict),
+        workers bounds the requests in flight and timeout is the number
+        of seconds a single request may take once it was started.
+        """
+        self.send_request = send_request
+        self.timeout = timeout
+        self.pool = ThreadPool(workers)
+
+    def poll(self, subids):
+        """
+        Return dict of subid -> submission status. Submissions which
+        timed out or failed are left out and should be polled again later.
+        """
+        started = dict()
+
+        def request(subid):
+            started[subid] = time.time()
+            result = self.send_request("submissions/%d" % subid)
+
+            # find out whether the job has already failed
+            jobs = [job for job in result.get("jobs", []) if job is not None]
+            if len(jobs) != 0 and len(result["job_calibrations"]) == 0:
+                result["job_status"] = self.send_request("jobs/%d" % jobs[0])["status"]
+            return result
+
+        tasks = [(subid, self.pool.apply_async(request, (subid,))) for subid in subids]
+
+        results = dict()
+        for (subid, task) in tasks:
+            while not task.ready():
+                start = started.get(subid)
+                if start is not None and time.time() - start > self.timeout:
+                    break
+                task.wait(0.05)
+
+            if not task.ready():
+                print "[WARN]:", "Polling of submission %d timed out." % subid
+            elif not task.successful():
+                try:
+                    task.get()
+                except Exception as e:
+                    print "[WARN]:", "Polling of submission %d failed:" % subid, e
+            else:
+                results[subid] = task.get()
+
+        return results
+
+    def close(self):
+        self.pool.terminate()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import email.utils
+import random
+import threading
+import time
+
+import requests
+from requests.packages.urllib3.util.retry import Retry
+
+
+# service -> (hosts, requests per second, burst) used until the service
+# tells its limits in the response headers
+SERVICES = {
+    "reddit": (["reddit.com"], 1.0, 10),
+    "imgur": (["api.imgur.com"], 1.0, 10),
+    "astrometry": (["nova.astrometry.net"], 10.0, 20),
+}
+
+# (remaining, reset) headers of the rate limits, reset is in seconds
+# or a unix timestamp
+LIMIT_HEADERS = [
+    ("x-ratelimit-remaining", "x-ratelimit-reset"),              # reddit
+    ("x-ratelimit-userremaining", "x-ratelimit-userreset"),      # imgur, per user
+    ("x-ratelimit-clientremaining", "x-ratelimit-clientreset"),  # imgur, per application
+    ("x-post-rate-limit-remaining", "x-post-rate-limit-reset"),  # imgur, uploads
+]
+
+MIN_RATE = 0.01     # never slow down to less than a request per 100 seconds
+
+
+def share(services, processes):
+    """
+    Split the limits of the services between the processes calling them,
+    each of which has its own buckets. processes is dict service -> number
+    of processes, services which are not in it are not split.
+    """
+    shared = dict()
+    for (service, (hosts, rate, burst)) in services.items():
+        n = max(processes.get(service, 1), 1)
+        shared[service] = (hosts, rate / float(n), max(burst // n, 1))
+    return shared
+
+
+class RateLimited(requests.exceptions.RequestException):
+    """
+    The service can't be called now without waiting too long.
+    """
+
+
+class TokenBucket:
+    """
+    Allow `rate` requests per second on average and up to `burst` at once.
+    Callers reserve their token and wait for it outside of the lock,
+    so they're served in order.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        # time of the last refill, in the future while paused
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self, max_wait=None):
+        """
+        Take a token, waiting for it if there's none. Return the time
+        waited, or None without taking the token if it'd be over max_wait.
+        """
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            wait = max(0, self.updated - now) + max(0, (1 - self.tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return None
+            self.tokens -= 1
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Give out no tokens for the next `seconds`.
+        """
+        with self.lock:
+            now = time.time()
+            self._refill(now)
+            self.tokens = min(self.tokens, 0)
+            self.updated = max(self.updated, now + seconds)
+
+    def limit(self, remaining, reset):
+        """
+        Spread the `remaining` requests evenly until the limits are reset
+        in `reset` seconds.
+        """
+        if remaining < 1:
+            self.pause(reset)
+            return
+
+        with self.lock:
+            self._refill(time.time())
+            self.rate = max(remaining / max(reset, 1.0), MIN_RATE)
+            self.tokens = min(self.tokens, remaining)
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+
+class RateLimiter:
+    """
+    Token bucket of every rate limited service, found by the host.
+    Hosts of other services are not limited.
+    """
+    def __init__(self, services):
+        # host -> (service, bucket)
+        self.hosts = dict()
+        for (service, (hosts, rate, burst)) in services.items():
+            bucket = TokenBucket(rate, burst)
+            for host in hosts:
+                self.hosts[host] = (service, bucket)
+
+    def find(self, netloc):
+        """
+        Return (service, bucket) of the host or any of its parent domains, or None.
+        """
+        labels = netloc.lower().split(":")[0].split(".")
+        for i in range(len(labels) - 1):
+            found = self.hosts.get(".".join(labels[i:]))
+            if found is not None:
+                return found
+        return None
+
+
+def parse_limits(headers, now=None):
+    """
+    Return the tightest (remaining, reset in seconds) of the rate limit
+    headers, or None if there are none.
+    """
+    now = now or time.time()
+    tightest = None
+    for (remaining_header, reset_header) in LIMIT_HEADERS:
+        try:
+            remaining = float(headers[remaining_header])
+            reset = float(headers[reset_header])
+        except (KeyError, ValueError):
+            continue
+        if reset > 1e9:
+            reset -= now
+        reset = max(reset, 0)
+        if tightest is None or remaining / max(reset, 1.0) < tightest[0] / max(tightest[1], 1.0):
+            tightest = (remaining, reset)
+    return tightest
+
+
+def retry_after(headers, now=None):
+    """
+    Return seconds to wait by the Retry-After header, or None.
+    """
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(email.utils.mktime_tz(date) - (now or time.time()), 0)
+
+
+def backoff(attempt, factor):
+    """
+    Exponential backoff with jitter, so that clients don't retry in sync.
+    """
+    delay = factor * (2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class JitteredRetry(Retry):
+    """
+    Retry of failed connections and server errors with jittered backoff.
+    """
+    def get_backoff_time(self):
+        delay = Retry.get_backoff_time(self)
+        return delay / 2 + random.uniform(0, delay / 2)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+import time
+import urlparse
+
+import requests
+from lxml import etree
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+HTML_CHUNK = 8192   # size of a single read of a web page
+
+
+class Resolver:
+    """
+    Resolve links of the posts to direct image URLs.
+
+    Web pages are resolved by functions registered for their host.
+    Resolved URLs are cached for `ttl` seconds, links which failed
+    to resolve for `failed_ttl` seconds.
+    """
+    def __init__(self, http, ttl, failed_ttl, max_cached=10000):
+        self.http = http
+        self.ttl = ttl
+        self.failed_ttl = failed_ttl
+        self.max_cached = max_cached
+
+        # host -> (accepts, resolve)
+        self.hosts = dict()
+
+        # url -> (expiration time, direct url or None)
+        self.cache = dict()
+
+    def register(self, host, accepts, resolve):
+        """
+        Register resolver of pages on the host (and its subdomains).
+        accepts(url) tells without network access whether the parsed url
+        can be resolved, resolve(resolver, url) returns direct url or None.
+        Urls which are not accepted are taken as direct if they look like images.
+        """
+        self.hosts[host] = (accepts, resolve)
+
+    def supports(self, rawUrl):
+        """
+        Decide whether the url can be resolved, without network access.
+        """
+        url = urlparse.urlparse(rawUrl)
+        handler = self._handler(url.netloc)
+        if handler is not None and handler[0](url):
+            return True
+
+        return is_image(url)
+
+    def resolve(self, rawUrl):
+        """
+        Get direct image url for the link, None if it can't be resolved.
+        """
+        now = time.time()
+        cached = self.cache.get(rawUrl)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        # pages of the registered hosts first, e.g. wikipedia's File:X.jpg is a page
+        url = urlparse.urlparse(rawUrl)
+        result = None
+        handler = self._handler(url.netloc)
+        if handler is not None and handler[0](url):
+            try:
+                result = handler[1](self, url)
+            except (requests.exceptions.RequestException, etree.LxmlError) as e:
+                print "[INFO]:", "Location can't be resolved:", e
+        elif is_image(url):
+            result = rawUrl
+
+        if len(self.cache) >= self.max_cached:
+            self._prune(now)
+        self.cache[rawUrl] = (now + (self.ttl if result is not None else self.failed_ttl), result)
+        return result
+
+    def find(self, url, match):
+        """
+        Stream the web page and return the first element for which
+        match(element) is true, without downloading the rest.
+        """
+        response = self.http.download(url, stream=True)
+        response.raise_for_status()
+
+        parser = etree.HTMLPullParser(events=("start",))
+        try:
+            for chunk in response.iter_content(HTML_CHUNK):
+                parser.feed(chunk)
+                for (_, element) in parser.read_events():
+                    if match(element):
+                        return element
+        finally:
+            response.close()
+
+        return None
+
+    def _handler(self, netloc):
+        """
+        Find resolver registered for the host or any of its parent domains.
+        """
+        labels = netloc.lower().split(":")[0].split(".")
+        for i in range(len(labels) - 1):
+            handler = self.hosts.get(".".join(labels[i:]))
+            if handler is not None:
+                return handler
+        return None
+
+    def _prune(self, now):
+        for (url, (expires, _)) in self.cache.items():
+            if expires <= now:
+                del(self.cache[url])
+
+        # still full, forget the oldest half
+        if len(self.cache) >= self.max_cached:
+            oldest = sorted(self.cache, key=lambda url: self.cache[url][0])
+            for url in oldest[:len(oldest) / 2]:
+                del(self.cache[url])
+
+
+def is_image(url):
+    return url.path.lower().endswith(IMAGE_EXTENSIONS)
+
+
+# --- imgur: direct url (skip sets and albums)
+def imgur_accepts(url):
+    return "a/" not in url.path and ("," not in url.path) and ("gifv" not in url.path) \
+        and not is_image(url)
+
+def imgur_resolve(resolver, url):
+    newloc = url.netloc
+    if not newloc.startswith("i."):
+        newloc = "i." + newloc
+    newpath = url.path
+    if newpath.endswith("/new"):
+        newpath = newpath[:-len("/new")]
+    newpath += ".jpg"
+    newpath = newpath.replace("gallery/", "")
+    newUrl = urlparse.ParseResult(url.scheme, newloc, newpath,
+                url.params, url.query, url.fragment)
+
+    return newUrl.geturl()
+
+
+# --- flickr: large size of the photo
+def flickr_accepts(url):
+    path = filter(lambda x: x != '', url.path.split('/'))
+    return len(path) >= 3 and path[0] == 'photos'
+
+def flickr_resolve(resolver, url):
+    path = filter(lambda x: x != '', url.path.split('/'))
+    newpath = '/photos/%s/%s/sizes/l' % (path[1], path[2])
+    newUrl = urlparse.ParseResult(url.scheme, url.netloc, newpath,
+                url.params, url.query, url.fragment)
+
+    img = resolver.find(newUrl.geturl(), lambda e: e.tag == "img" and
+                        e.getparent() is not None and e.getparent().get("id") == "allsizes-photo")
+    if img is not None and img.get("src"):
+        return img.get("src")
+    return None
+
+
+# --- apod: the first image of the page
+def apod_accepts(url):
+    return not is_image(url)
+
+def apod_resolve(resolver, url):
+    img = resolver.find(url.geturl(), lambda e: e.tag == "img" and e.get("src"))
+    if img is not None:
+        return "http://apod.nasa.gov/apod/" + img.get("src")
+    return None
+
+
+# --- wikipedia: the full resolution file
+def wikipedia_accepts(url):
+    return "File:" in url.path
+
+def wikipedia_resolve(resolver, url):
+    def in_full_media(e):
+        return any("fullMedia" in (parent.get("class") or "").split() for parent in e.iterancestors())
+
+    a = resolver.find(url.geturl(), lambda e: e.tag == "a" and e.get("href") and in_full_media(e))
+    if a is not None:
+        return "http:" + a.get("href")
+    return None
+
+
+def default_resolver(http, ttl, failed_ttl):
+    """
+    Create resolver of all the supported hosts.
+    """
+    resolver = Resolver(http, ttl, failed_ttl)
+    resolver.register("imgur.com", imgur_accepts, imgur_resolve)
+    resolver.register("flickr.com", flickr_accepts, flickr_resolve)
+    resolver.register("apod.nasa.gov", apod_accepts, apod_resolve)
+    resolver.register("wikipedia.org", wikipedia_accepts, wikipedia_resolve)
+    return resolver
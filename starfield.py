@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Guess whether an image shows a star field which Astrometry can solve,
+from a small thumbnail: the stars are counted as point-like local
+maxima standing out of the background noise. Images with few stars
+also need a dark background, while enough stars pass on their own, so
+that close-ups of bright nebulae filling the frame are kept. Planets,
+the Moon and daylight photos have few or no such points.
+"""
+
+import io
+
+import numpy as np
+from PIL import Image
+
+
+THUMBNAIL_SIZE = 512    # larger side of the analyzed thumbnail
+MIN_STARS = 20          # number of stars for full confidence
+MIN_CONTRAST = 16       # min brightness of a star above the background (0-255)
+NOISE_SIGMAS = 5        # min brightness of a star above the background, in noise levels
+STAR_RADIUS = 3         # a star fades to half its brightness within this many pixels
+BACKGROUND_BLOCK = 16   # side of the blocks the local background is estimated in
+DARK_BACKGROUND = 60    # background up to this brightness is surely night sky
+BRIGHT_BACKGROUND = 160 # background from this brightness is surely daylight
+
+
+def thumbnail(data):
+    """
+    Decode the image data to a grayscale thumbnail, letting the JPEG
+    decoder skip most of the work.
+    """
+    image = Image.open(io.BytesIO(data))
+    ratio = float(THUMBNAIL_SIZE) / max(image.size)
+    if ratio < 1:
+        image.draft("L", (int(image.size[0] * ratio), int(image.size[1] * ratio)))
+    image = image.convert("L")
+    image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.ANTIALIAS)
+    return np.asarray(image, dtype=np.float32)
+
+
+def local_background(pixels):
+    """
+    Median of every BACKGROUND_BLOCK square, spread back over its pixels,
+    so that nebulae and gradients are not taken for the noise.
+    """
+    (height, width) = pixels.shape
+    b = BACKGROUND_BLOCK
+    (rows, cols) = (-(-height // b), -(-width // b))
+    padded = np.pad(pixels, ((0, rows * b - height), (0, cols * b - width)), "edge")
+    blocks = np.median(padded.reshape(rows, b, cols, b).swapaxes(1, 2).reshape(rows, cols, b * b), axis=2)
+    return np.repeat(np.repeat(blocks, b, axis=0), b, axis=1)[:height, :width]
+
+
+def statistics(pixels):
+    """
+    Return dict with the background level, its noise and the number of stars.
+    """
+    background = float(np.median(pixels))
+    local = local_background(pixels)
+    noise = 1.4826 * float(np.median(np.abs(pixels - local)))
+
+    # local maxima of the inner pixels, above the local background
+    r = STAR_RADIUS
+    (height, width) = pixels.shape
+    if height <= 2 * r or width <= 2 * r:
+        return dict(background=background, noise=noise, stars=0)
+
+    local = local[r:height - r, r:width - r]
+    contrast = max(NOISE_SIGMAS * noise, MIN_CONTRAST)
+    threshold = local + contrast
+
+    core = pixels[r:height - r, r:width - r]
+    def shifted(dy, dx):
+        return pixels[r + dy:height - r + dy, r + dx:width - r + dx]
+
+    peaks = core > threshold
+    for (dy, dx) in [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]:
+        peaks &= core >= shifted(dy, dx)
+
+    # point-like: fading to the background all around, unlike edges
+    # and insides of bright areas
+    half = local + (core - local) / 2
+    for (dy, dx) in [(-r, 0), (r, 0), (0, -r), (0, r)]:
+        around = shifted(dy, dx)
+        peaks &= (around < half) & (around > local - contrast)
+
+    return dict(background=background, noise=noise, stars=int(np.count_nonzero(peaks)))
+
+
+def confidence(data):
+    """
+    Return confidence from 0 to 1 that the image is a solvable star field,
+    and the statistics it's based on.
+    """
+    stats = statistics(thumbnail(data))
+    if stats["stars"] >= MIN_STARS:
+        return (1.0, stats)
+
+    stars = stats["stars"] / float(MIN_STARS)
+    dark = np.clip((BRIGHT_BACKGROUND - stats["background"]) /
+                   float(BRIGHT_BACKGROUND - DARK_BACKGROUND), 0.0, 1.0)
+    return (float(stars * dark), stats)
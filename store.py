@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+import json
+import sqlite3
+
+import fingerprint
+
+
+class Store:
+    """
+    Persistent state of the bot kept in SQLite database,
+    so that a restart doesn't lose the submissions in progress.
+    """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS submissions ("
+                            "subid INTEGER PRIMARY KEY, post_id TEXT NOT NULL, "
+                            "next_poll REAL NOT NULL, interval REAL NOT NULL, "
+                            "deadline REAL NOT NULL, width INTEGER, height INTEGER, "
+                            "scale REAL NOT NULL DEFAULT 1, "
+                            "job_id INTEGER, image_id INTEGER)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS skipped ("
+                            "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                            "post_id TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS state ("
+                            "key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS comments ("
+                            "comment_id TEXT PRIMARY KEY, post_id TEXT NOT NULL, "
+                            "author TEXT, permalink TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS comments_post ON comments (post_id)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tags ("
+                            "seq INTEGER PRIMARY KEY AUTOINCREMENT, time REAL NOT NULL, "
+                            "subreddit TEXT, post_id TEXT NOT NULL, tag TEXT NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tag_counts ("
+                            "tag TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS solutions ("
+                            "hash TEXT PRIMARY KEY, aspect REAL NOT NULL, "
+                            "subid INTEGER NOT NULL, job_id INTEGER NOT NULL, "
+                            "image_id INTEGER NOT NULL, ra REAL NOT NULL, dec REAL NOT NULL, "
+                            "radius REAL NOT NULL, range REAL NOT NULL, tags TEXT NOT NULL, "
+                            "annotated_image TEXT, author TEXT)")
+
+    # --- key-value state
+    def get(self, key, default=None):
+        row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return default
+        return row["value"]
+
+    def set(self, key, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    # --- submissions
+    def add_submission(self, metadata):
+        (width, height) = metadata["image_size"]
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO submissions "
+                            "(subid, post_id, next_poll, interval, deadline, width, height, scale) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (metadata["id"], metadata["post"].id, metadata["next_poll"],
+                             metadata["interval"], metadata["deadline"], width, height,
+                             metadata["scale"]))
+
+    def update_schedule(self, subid, next_poll, interval):
+        with self.db:
+            self.db.execute("UPDATE submissions SET next_poll = ?, interval = ? WHERE subid = ?",
+                            (next_poll, interval, subid))
+
+    def set_solved(self, subid, job_id, image_id):
+        with self.db:
+            self.db.execute("UPDATE submissions SET job_id = ?, image_id = ? WHERE subid = ?",
+                            (job_id, image_id, subid))
+
+    def remove_submission(self, subid):
+        with self.db:
+            self.db.execute("DELETE FROM submissions WHERE subid = ?", (subid,))
+
+    def submissions(self):
+        """
+        Return metadata of all stored submissions, without the reddit post.
+        """
+        result = []
+        for row in self.db.execute("SELECT * FROM submissions ORDER BY subid"):
+            metadata = dict()
+            metadata["id"] = row["subid"]
+            metadata["post_id"] = row["post_id"]
+            metadata["next_poll"] = row["next_poll"]
+            metadata["interval"] = row["interval"]
+            metadata["deadline"] = row["deadline"]
+            metadata["image_size"] = (row["width"], row["height"])
+            metadata["scale"] = row["scale"]
+            if row["job_id"] is not None:
+                metadata["job_id"] = row["job_id"]
+                metadata["image_id"] = row["image_id"]
+            result.append(metadata)
+        return result
+
+    # --- skipped posts
+    def skip(self, post_id, limit):
+        """
+        Remember skipped post, keeping only the last `limit` ones.
+        """
+        with self.db:
+            cursor = self.db.execute("INSERT INTO skipped (post_id) VALUES (?)", (post_id,))
+            self.db.execute("DELETE FROM skipped WHERE seq <= ?", (cursor.lastrowid - limit,))
+
+    def skipped(self, limit):
+        rows = self.db.execute("SELECT post_id FROM skipped ORDER BY seq DESC LIMIT ?", (limit,))
+        return [row["post_id"] for row in reversed(rows.fetchall())]
+
+    # --- index of posted comments
+    def add_comment(self, comment_id, post_id, author, permalink):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO comments "
+                            "(comment_id, post_id, author, permalink) VALUES (?, ?, ?, ?)",
+                            (comment_id, post_id, author, permalink))
+
+    def add_history(self, comments):
+        """
+        Index comments posted before the index existed, from list of
+        (comment_id, post_id). Their owner is not known.
+        """
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO comments (comment_id, post_id) VALUES (?, ?)",
+                                comments)
+
+    def comment(self, comment_id):
+        """
+        Return dict with post_id, author and permalink of the comment, or None
+        if it's not indexed or its owner is not known.
+        """
+        row = self.db.execute("SELECT * FROM comments WHERE comment_id = ?",
+                              (comment_id,)).fetchone()
+        if row is None or row["permalink"] is None:
+            return None
+        return dict(post_id=row["post_id"], author=row["author"], permalink=row["permalink"])
+
+    def has_comment_on(self, post_id):
+        return self.db.execute("SELECT 1 FROM comments WHERE post_id = ? LIMIT 1",
+                               (post_id,)).fetchone() is not None
+
+    def remove_comment(self, comment_id):
+        with self.db:
+            self.db.execute("DELETE FROM comments WHERE comment_id = ?", (comment_id,))
+
+    # --- tag statistics
+    def add_tags(self, post_id, subreddit, tags, time):
+        """
+        Append tags of the solved post to the log.
+        """
+        with self.db:
+            self.db.executemany("INSERT INTO tags (time, subreddit, post_id, tag) VALUES (?, ?, ?, ?)",
+                                [(time, subreddit, post_id, tag) for tag in tags])
+
+    def has_tags(self, post_id):
+        return self.db.execute("SELECT 1 FROM tags WHERE post_id = ? LIMIT 1",
+                               (post_id,)).fetchone() is not None
+
+    def tag_counts(self):
+        """
+        Return list of (tag, count), the most common first. Only the
+        tags logged since the last checkpoint are added to the counts.
+        """
+        checkpoint = int(self.get("tags_checkpoint", 0))
+        last = self.db.execute("SELECT MAX(seq) FROM tags").fetchone()[0]
+        if last is not None and last > checkpoint:
+            with self.db:
+                new = self.db.execute("SELECT tag, COUNT(*) FROM tags WHERE seq > ? AND seq <= ? "
+                                      "GROUP BY tag", (checkpoint, last)).fetchall()
+                for (tag, count) in new:
+                    self.db.execute("INSERT OR IGNORE INTO tag_counts (tag, count) VALUES (?, 0)", (tag,))
+                    self.db.execute("UPDATE tag_counts SET count = count + ? WHERE tag = ?", (count, tag))
+                self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                                ("tags_checkpoint", last))
+
+        rows = self.db.execute("SELECT tag, count FROM tag_counts ORDER BY count DESC, tag")
+        return [(row["tag"], row["count"]) for row in rows]
+
+    def tag_counts_by(self, group):
+        """
+        Return list of (group, tag, count) where group is "day" or "subreddit".
+        """
+        column = {"day": "date(time, 'unixepoch')", "subreddit": "subreddit"}[group]
+        rows = self.db.execute("SELECT %s, tag, COUNT(*) FROM tags GROUP BY 1, 2 "
+                               "ORDER BY 1, 3 DESC, 2" % column)
+        return [tuple(row) for row in rows]
+
+    # --- solutions of images by their perceptual hash
+    def add_solution(self, hash, aspect, metadata):
+        """
+        Remember the solution of the image, to be reused by its duplicates.
+        """
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO solutions "
+                            "(hash, aspect, subid, job_id, image_id, ra, dec, radius, range, "
+                            "tags, annotated_image, author) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (hash, aspect, metadata["id"], metadata["job_id"], metadata["image_id"],
+                             metadata["rectascension"], metadata["declination"], metadata["radius"],
+                             metadata["range"], json.dumps(metadata["tags"]),
+                             metadata["annotated_image"], metadata["author"]))
+
+    def find_solution(self, hash, aspect, max_distance, aspect_tolerance):
+        """
+        Return metadata of the solved image closest to the hash, or None
+        if no image of about the same aspect ratio is within max_distance.
+        """
+        best = None
+        for row in self.db.execute("SELECT hash, aspect FROM solutions"):
+            if abs(row["aspect"] - aspect) > aspect * aspect_tolerance:
+                continue
+            d = fingerprint.distance(hash, row["hash"])
+            if d <= max_distance and (best is None or d < best[0]):
+                best = (d, row["hash"])
+        if best is None:
+            return None
+
+        row = self.db.execute("SELECT * FROM solutions WHERE hash = ?", (best[1],)).fetchone()
+        return dict(id=row["subid"], job_id=row["job_id"], image_id=row["image_id"],
+                    rectascension=row["ra"], declination=row["dec"], radius=row["radius"],
+                    range=row["range"], tags=json.loads(row["tags"]),
+                    annotated_image=row["annotated_image"], author=row["author"])
+
+    def close(self):
+        self.db.close()
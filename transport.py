@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import time
+import urlparse
+import warnings
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages import urllib3
+
+import ratelimit
+
+
+MAX_WAIT = 120  # longer waits for a rate limit fail the request instead
+
+
+class Adapter(HTTPAdapter):
+    """
+    Connection pools of the session, measuring every request by host.
+    Requests to rate limited services are paced by their token bucket,
+    and the requests refused for the rate (429) are retried.
+    """
+    def __init__(self, metrics=None, limiter=None, retries=3, backoff=0.5, **kwargs):
+        HTTPAdapter.__init__(self, **kwargs)
+        self.metrics = metrics
+        self.limiter = limiter
+        self.retries = retries
+        self.backoff = backoff
+
+    def send(self, request, **kwargs):
+        host = urlparse.urlparse(request.url).netloc
+        limited = self.limiter.find(host) if self.limiter is not None else None
+
+        attempt = 0
+        while True:
+            if limited is not None:
+                waited = limited[1].acquire(MAX_WAIT)
+                if waited is None:
+                    raise ratelimit.RateLimited("%s is rate limited for more than %d seconds"
+                                                % (limited[0], MAX_WAIT), request=request)
+                if waited > 0 and self.metrics is not None:
+                    self.metrics.observe("astrobot_ratelimit_wait_seconds", waited, service=limited[0])
+
+            response = self._send(host, request, **kwargs)
+
+            if limited is not None:
+                limits = ratelimit.parse_limits(response.headers)
+                if limits is not None:
+                    limited[1].limit(*limits)
+
+            if response.status_code != 429 or attempt >= self.retries:
+                return response
+
+            # the request was refused, so it's safe to repeat even if it's a POST
+            delay = ratelimit.retry_after(response.headers)
+            if delay is None:
+                delay = ratelimit.backoff(attempt, self.backoff)
+            if delay > MAX_WAIT:
+                return response
+
+            if self.metrics is not None:
+                self.metrics.inc("astrobot_ratelimit_retries_total", host=host)
+            response.close()
+            if limited is not None:
+                limited[1].pause(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+    def _send(self, host, request, **kwargs):
+        if self.metrics is None:
+            return HTTPAdapter.send(self, request, **kwargs)
+
+        with self.metrics.timed("astrobot_http_request", host=host):
+            response = HTTPAdapter.send(self, request, **kwargs)
+        self.metrics.inc("astrobot_http_responses_total", host=host, status=response.status_code)
+        return response
+
+
+class Session(requests.Session):
+    """
+    HTTP session shared by all outbound calls of the bot. Connections
+    to every host are pooled and kept alive, every request has a timeout
+    and failed connections and server errors are retried with backoff.
+    Rate limits of the services are kept by the limiter, if given.
+    """
+    def __init__(self, user_agent, pool_size=16, retries=3, backoff=0.5, timeout=(10, 60),
+                 metrics=None, limiter=None):
+        requests.Session.__init__(self)
+        self.headers["User-Agent"] = user_agent
+        self.timeout = timeout
+
+        # unverified downloads (see download()) are reported once per host
+        warnings.filterwarnings("once", category=urllib3.exceptions.InsecureRequestWarning)
+
+        retry = ratelimit.JitteredRetry(total=retries, backoff_factor=backoff,
+                                        status_forcelist=[500, 502, 503, 504])
+        adapter = Adapter(metrics, limiter, retries, backoff, pool_connections=pool_size,
+                          pool_maxsize=pool_size, max_retries=retry)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def share(self, session):
+        """
+        Let another requests session use the connection pools of this one.
+        """
+        for (prefix, adapter) in self.adapters.items():
+            session.mount(prefix, adapter)
+
+    def download(self, url, **kwargs):
+        """
+        GET an image or a web page. Certificates of the image hosts are
+        often misconfigured, so they're not verified; API calls, which
+        carry credentials, always are.
+        """
+        kwargs["verify"] = False
+        return self.get(url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return requests.Session.request(self, method, url, **kwargs)
@@ -1,30 +1,66 @@
 #!/usr/bin/env python
+"""
+Export counts of the tags posted by astro-bot for the wordcloud.
+"""
 
-import praw
-import credentials
-from collections import Counter
-
-reddit = praw.Reddit(user_agent = credentials.USER_AGENT)
-reddit.login(credentials.REDDIT_USER, credentials.REDDIT_PASSWORD)
-
-tagsCounter = Counter()
-comments = 0
-
-redditor = reddit.get_redditor("astro-bot")
-for comment in redditor.get_overview(limit=None):
-    if isinstance(comment, praw.objects.Comment):
-        tagsLine = filter(lambda s: "Tags^1" in s, comment.body.split("\n"))
-        if len(tagsLine):
-            tagsLine = tagsLine[0].replace("Tags^1: ","").replace("...","")\
-                                   .replace("&gt;","").replace("*","")
-            tags = tagsLine.split(",")
-            for tag in tags:
-                tagsCounter[tag.strip()] += 1
-            comments += 1
-
-print comments,"comments processed"
-
-csv = open("wordcloud.csv","w+")
-for (tag, count) in tagsCounter.most_common():
-    line = tag + ":" + str(count) + "\n"
-    csv.write(line.encode("UTF-8"))
+import argparse
+
+from store import Store
+
+
+def import_history(store):
+    """
+    Add tags of the comments found in astro-bot's reddit history
+    which are not in the store yet.
+    """
+    import praw
+    import credentials
+
+    reddit = praw.Reddit(user_agent = credentials.USER_AGENT)
+    reddit.login(credentials.REDDIT_USER, credentials.REDDIT_PASSWORD)
+
+    comments = 0
+    redditor = reddit.get_redditor("astro-bot")
+    for comment in redditor.get_overview(limit=None):
+        if isinstance(comment, praw.objects.Comment):
+            post_id = comment.link_id[3:]
+            if store.has_tags(post_id):
+                continue
+
+            tagsLine = filter(lambda s: "Tags^1" in s, comment.body.split("\n"))
+            if len(tagsLine):
+                tagsLine = tagsLine[0].replace("Tags^1: ","").replace("...","")\
+                                       .replace("&gt;","").replace("*","")
+                tags = [tag.strip() for tag in tagsLine.split(",")]
+                store.add_tags(post_id, comment.subreddit.display_name, tags,
+                               comment.created_utc)
+                comments += 1
+
+    print comments,"comments imported"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db", default="astrobot.db", help="state of astrobot")
+    parser.add_argument("--by", choices=["day", "subreddit"],
+                        help="count tags separately for every day or subreddit")
+    parser.add_argument("--import-history", action="store_true",
+                        help="import tags from astro-bot's reddit comments first")
+    parser.add_argument("-o", "--output", default="wordcloud.csv")
+    args = parser.parse_args()
+
+    store = Store(args.db)
+    if args.import_history:
+        import_history(store)
+
+    csv = open(args.output, "w+")
+    if args.by is None:
+        for (tag, count) in store.tag_counts():
+            line = tag + ":" + str(count) + "\n"
+            csv.write(line.encode("UTF-8"))
+    else:
+        for (group, tag, count) in store.tag_counts_by(args.by):
+            line = group + ":" + tag + ":" + str(count) + "\n"
+            csv.write(line.encode("UTF-8"))
+    csv.close()
+    store.close()
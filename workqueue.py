@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import json
+import os
+import sqlite3
+import time
+
+
+class WorkQueue:
+    """
+    Durable queue of tasks passed between the processes of the bot.
+    Every task belongs to a stage (e.g. "poll") and carries JSON payload.
+    A claimed task is owned by the claiming process until it is moved
+    to another stage or done.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, stage TEXT NOT NULL, "
+                        "payload TEXT NOT NULL, due REAL NOT NULL, owner INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_stage ON tasks (stage, owner, due)")
+
+    def reopen(self):
+        """
+        Return new connection to the queue, for use in a forked process.
+        """
+        return WorkQueue(self.path)
+
+    def put(self, stage, payload, due=0):
+        self.db.execute("INSERT INTO tasks (stage, payload, due) VALUES (?, ?, ?)",
+                        (stage, json.dumps(payload), due))
+
+    def claim(self, stage, limit=1):
+        """
+        Take up to `limit` tasks of the stage which are due.
+        Return list of (task id, payload).
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.db.execute("SELECT id, payload FROM tasks "
+                                   "WHERE stage = ? AND owner IS NULL AND due <= ? "
+                                   "ORDER BY due LIMIT ?", (stage, time.time(), limit)).fetchall()
+            self.db.executemany("UPDATE tasks SET owner = ? WHERE id = ?",
+                                [(os.getpid(), task_id) for (task_id, _) in rows])
+            self.db.execute("COMMIT")
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+
+        return [(task_id, json.loads(payload)) for (task_id, payload) in rows]
+
+    def move(self, task_id, stage, payload, due=0):
+        """
+        Hand the claimed task over to the stage (or back to the same one).
+        """
+        self.db.execute("UPDATE tasks SET stage = ?, payload = ?, due = ?, owner = NULL "
+                        "WHERE id = ?", (stage, json.dumps(payload), due, task_id))
+
+    def done(self, task_id):
+        self.db.execute("DELETE FROM tasks WHERE id = ?", (task_id,))
+
+    def release(self):
+        """
+        Return the tasks claimed by processes which no longer run.
+        """
+        self.db.execute("UPDATE tasks SET owner = NULL WHERE owner IS NOT NULL")
+
+    def pending(self, stage):
+        return self.db.execute("SELECT COUNT(*) FROM tasks WHERE stage = ?", (stage,)).fetchone()[0]
+
+    def close(self):
+        self.db.close()